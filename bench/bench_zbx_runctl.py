@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+
+# Author: AcidGo
+# Usage:
+#   zbx_runctl 的基准测试，不依赖真实的 systemctl 与 /etc/zabbix：
+#       - 生成 100 ~ 100k 行的 agent 配置，可指定 UserParameter 与 Include 文件数量。
+#       - 在 PATH 前置带可调延迟的假 systemctl/service/chkconfig。
+#       - 将 zbx_runctl 的配置路径重定向到生成的配置。
+#   每个场景在独立的子进程中运行，统计端到端耗时、子进程数量与峰值 RSS。
+#
+#   python bench/bench_zbx_runctl.py --sizes 100,1000,10000,100000 --modes check,edit,status,restart
+#   python bench/bench_zbx_runctl.py --latency 0.05 --json > bench_output.txt
+#   python bench/bench_zbx_runctl.py --import-budget 50
+#       冷启动预算检查：在全新的解释器中导入 zbx_runctl（使用已缓存的字节码），导入耗时的中位数
+#       超过预算（毫秒），或导入时加载了 LAZY_MODULES 中的模块时，以退出码 1 结束。
+#       直接运行脚本文件时每次都需要编译源码，高频调用时应使用 python -m zbx_runctl。
+
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# zbx_runctl 导入时不应加载的模块，它们只在对应的代码路径中才导入
+LAZY_MODULES = ("platform", "subprocess", "argparse", "json", "win32serviceutil", "socket", "ctypes")
+IMPORT_PROBE = (
+    "import sys, time\n"
+    "begin = time.time()\n"
+    "sys.path.insert(0, sys.argv[1])\n"
+    "import zbx_runctl\n"
+    "elapsed = time.time() - begin\n"
+    "print('%.6f %s' % (elapsed, ','.join(m for m in sys.argv[2].split(',') if m in sys.modules)))\n"
+)
+
+# 假的 systemctl：按 $FAKE_STATE_DIR/<unit> 是否存在判断服务是否运行，调用记录写入 $FAKE_CALLS
+FAKE_SYSTEMCTL = r'''#!/bin/sh
+echo "systemctl $*" >> "$FAKE_CALLS"
+sleep "$FAKE_LATENCY"
+action="$1"
+shift
+case "$action" in
+show)
+    units=""
+    while [ $# -gt 0 ]; do
+        case "$1" in
+        -p) shift 2 ;;
+        -*) shift ;;
+        *) units="$units $1"; shift ;;
+        esac
+    done
+    first=1
+    for unit in $units; do
+        [ $first -eq 1 ] || echo
+        first=0
+        name="${unit%.service}"
+        echo "Id=$unit"
+        case " $FAKE_UNITS " in
+        *" $name "*)
+            echo "LoadState=loaded"
+            echo "UnitFileState=enabled"
+            if [ -f "$FAKE_STATE_DIR/$name" ]; then
+                echo "ActiveState=active"; echo "SubState=running"; echo "MainPID=$$"
+                echo "ActiveEnterTimestamp=Mon 2026-01-05 10:00:00 UTC"
+            else
+                echo "ActiveState=inactive"; echo "SubState=dead"; echo "MainPID=0"
+                echo "ActiveEnterTimestamp="
+            fi
+            ;;
+        *)
+            echo "LoadState=not-found"; echo "UnitFileState="; echo "ActiveState=inactive"
+            echo "SubState=dead"; echo "MainPID=0"; echo "ActiveEnterTimestamp="
+            ;;
+        esac
+    done
+    ;;
+start|restart)
+    touch "$FAKE_STATE_DIR/${1%.service}" ;;
+stop)
+    rm -f "$FAKE_STATE_DIR/${1%.service}" ;;
+is-enabled|status)
+    case " $FAKE_UNITS " in *" ${1%.service} "*) exit 0 ;; esac
+    exit 1 ;;
+list-unit-files|list-units)
+    for name in $FAKE_UNITS; do echo "$name.service enabled"; done ;;
+esac
+exit 0
+'''
+
+FAKE_SERVICE = r'''#!/bin/sh
+echo "service $*" >> "$FAKE_CALLS"
+sleep "$FAKE_LATENCY"
+case "$2" in
+start|restart) touch "$FAKE_STATE_DIR/$1" ;;
+stop) rm -f "$FAKE_STATE_DIR/$1" ;;
+status) [ -f "$FAKE_STATE_DIR/$1" ] || exit 3 ;;
+esac
+exit 0
+'''
+
+FAKE_CHKCONFIG = r'''#!/bin/sh
+echo "chkconfig $*" >> "$FAKE_CALLS"
+sleep "$FAKE_LATENCY"
+case " $FAKE_UNITS " in *" $1 "*) exit 0 ;; esac
+exit 1
+'''
+
+
+def generate_agent_config(config_path, lines, userparameters=0, includes=0):
+    """生成 agent 配置文件。
+
+    Args:
+        config_path: 主配置文件路径，Include 文件生成在同目录的 zabbix_agentd.d 下。
+        lines: 主配置文件的总行数，不足的部分以注释填充。
+        userparameters: 主配置文件中的 UserParameter 数量。
+        includes: Include 文件数量，每个文件包含 10 个 UserParameter。
+    """
+    include_dir = os.path.join(os.path.dirname(config_path), "zabbix_agentd.d")
+    line_lst = [
+        "# This is a generated configuration file for zabbix agent",
+        "PidFile=/var/run/zabbix/zabbix_agentd.pid",
+        # 日志目录需要存在且可写，否则 edit 前的配置校验不会通过
+        "LogFile={!s}".format(os.path.join(os.path.dirname(config_path), "zabbix_agentd.log")),
+        "LogFileSize=0",
+        "Server=127.0.0.1",
+        "ServerActive=127.0.0.1",
+        "Hostname=bench",
+        "ListenPort=10050",
+        "Timeout=3",
+    ]
+    if includes:
+        line_lst.append("Include={!s}/*.conf".format(include_dir))
+    line_lst += ["UserParameter=bench.item{!s}[*],echo {!s} $1".format(i, i) for i in range(userparameters)]
+    filler = max(lines - len(line_lst), 0)
+    # 与真实配置类似，注释与空行交错
+    line_lst[1:1] = ["" if i % 4 == 3 else "### Option: Bench{!s}".format(i) for i in range(filler)]
+    with open(config_path, "w") as f:
+        f.write("\n".join(line_lst) + "\n")
+    if includes:
+        if not os.path.isdir(include_dir):
+            os.makedirs(include_dir)
+        for n in range(includes):
+            with open(os.path.join(include_dir, "bench{!s}.conf".format(n)), "w") as f:
+                for i in range(10):
+                    f.write("UserParameter=bench.inc{!s}.item{!s},echo {!s}\n".format(n, i, i))
+
+def install_fake_tools(bin_dir):
+    """在 bin_dir 下生成假的 systemctl、service、chkconfig。
+    """
+    for name, content in (("systemctl", FAKE_SYSTEMCTL), ("service", FAKE_SERVICE), ("chkconfig", FAKE_CHKCONFIG)):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+def run_worker(args):
+    """在当前进程中运行一个场景，结果以 JSON 输出到标准输出。
+    """
+    import resource
+    sys.path.insert(0, ROOT_DIR)
+    logging.basicConfig(level=logging.WARNING)
+    fork_count = [0]
+    popen = subprocess.Popen
+
+    class CountingPopen(popen):
+        def __init__(self, *a, **kw):
+            fork_count[0] += 1
+            popen.__init__(self, *a, **kw)
+
+    subprocess.Popen = CountingPopen
+    begin = time.time()
+    import zbx_runctl
+    import_time = time.time() - begin
+    zbx_runctl.ZBX_LNX_AGENTD_CONF_PATH = args.config
+    zbx_runctl.ZBX_CONF_PARSE_CACHE_PATH = os.path.join(args.workdir, "parse_cache.json")
+    zbx_runctl.ZBX_LOG_STATE_PATH = os.path.join(args.workdir, "log_state.json")
+    zbx_runctl.SERVICE_READY_INTERVAL = args.latency or 0.01
+    facts = zbx_runctl.get_host_facts()
+    facts.init_system = "systemd"
+    # status 与重启后的校验会通过 ZBXD 协议访问 agent，由本地的假 agent 应答
+    fake_agent = zbx_runctl.FakeZabbixAgent().start()
+    zbx_runctl.agent_endpoint = lambda config_path: (fake_agent.host, fake_agent.port)
+    edit_kwargs = dict.fromkeys(("zbx_cnf_server", "zbx_cnf_activeserver", "zbx_cnf_hostname", "zbx_cnf_listenport", "zbx_cnf_logpath"))
+    if args.mode == "edit":
+        # 每次使用不同的值，保证 edit 会真正写入并重启
+        edit_kwargs["zbx_cnf_server"] = "10.{!s}.{!s}.{!s}".format(os.getpid() % 250, int(time.time()) % 250, args.size % 250)
+    begin = time.time()
+    rc = 0
+    try:
+        zbx_runctl.execute(args.mode, **edit_kwargs)
+    except SystemExit as e:
+        rc = e.code or 0
+    except Exception as e:
+        logging.error("the mode {!s} failed: {!s}".format(args.mode, e))
+        rc = 1
+    wall = time.time() - begin
+    print(json.dumps({
+        "mode": args.mode,
+        "size": args.size,
+        "rc": rc,
+        "import": round(import_time, 4),
+        "wall": round(wall, 4),
+        "forks": fork_count[0],
+        # Linux 下 ru_maxrss 的单位为 KB
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # 各阶段（traced 与 Metrics.span）的次数与累计耗时
+        "phases": zbx_runctl.get_metrics().summary()["phases"],
+    }))
+
+def run_scenario(workdir, mode, size, userparameters, includes, latency):
+    config_path = os.path.join(workdir, "conf", "zabbix_agentd.conf")
+    calls_path = os.path.join(workdir, "calls.log")
+    if os.path.isdir(os.path.dirname(config_path)):
+        shutil.rmtree(os.path.dirname(config_path))
+    os.makedirs(os.path.dirname(config_path))
+    generate_agent_config(config_path, size, userparameters, includes)
+    open(calls_path, "w").close()
+    env = dict(os.environ)
+    env.update({
+        "PATH": os.path.join(workdir, "bin") + os.pathsep + env.get("PATH", ""),
+        "FAKE_CALLS": calls_path,
+        "FAKE_STATE_DIR": os.path.join(workdir, "state"),
+        "FAKE_LATENCY": str(latency),
+        "FAKE_UNITS": "zabbix-agent",
+    })
+    command_lst = [sys.executable, os.path.abspath(__file__), "--worker", "--workdir", workdir,
+        "--config", config_path, "--mode", mode, "--size", str(size), "--latency", str(latency)]
+    begin = time.time()
+    output = subprocess.check_output(command_lst, env=env)
+    res = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    res["process_wall"] = round(time.time() - begin, 4)
+    with open(calls_path, "r") as f:
+        res["tool_calls"] = len(f.read().splitlines())
+    res["userparameters"] = userparameters
+    res["includes"] = includes
+    return res
+
+def format_phases(phase_dict):
+    """将各阶段的累计耗时格式化为 name=毫秒，按耗时从大到小排列。
+    """
+    phase_lst = sorted(phase_dict.items(), key=lambda i: (-i[1]["duration"], i[0]))
+    return " ".join("{!s}={:.1f}ms".format(name, phase["duration"] * 1000) for name, phase in phase_lst) or "-"
+
+def format_table(result_lst):
+    header = ("MODE", "LINES", "UPARAMS", "INCLUDES", "RC", "IMPORT", "WALL", "PROCESS", "FORKS", "TOOLS", "PEAK_RSS_KB", "PHASES")
+    row_lst = [header]
+    for i in result_lst:
+        row_lst.append((i["mode"], i["size"], i["userparameters"], i["includes"], i["rc"],
+            "{:.4f}".format(i["import"]), "{:.4f}".format(i["wall"]), "{:.4f}".format(i["process_wall"]),
+            i["forks"], i["tool_calls"], i["peak_rss_kb"], format_phases(i["phases"])))
+    width_lst = [max(len(str(row[n])) for row in row_lst) for n in range(len(header))]
+    # 阶段列长度不一，左对齐放在最后
+    return "\n".join("  ".join(str(v).rjust(w) for v, w in zip(row[:-1], width_lst)) + "  " + row[-1] for row in row_lst)
+
+def check_import_budget(budget_ms, repeat=5):
+    """在全新的解释器中反复导入 zbx_runctl，检查导入耗时与导入时加载的模块。
+    同时测量空解释器的启动耗时作为参照，两者之和即 status 等模式的固定启动开销。
+
+    Returns:
+        <bool>: 是否满足预算。
+    """
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    def run(command_lst):
+        begin = time.time()
+        output = subprocess.check_output(command_lst, env=env).decode("utf-8").strip()
+        return time.time() - begin, output
+
+    probe_lst = [sys.executable, "-c", IMPORT_PROBE, ROOT_DIR, ",".join(LAZY_MODULES)]
+    # 第一次导入生成字节码缓存，同时作为未缓存时的参照
+    source_time = float(run(probe_lst)[1].partition(" ")[0])
+    baseline_lst, import_lst, loaded = [], [], set()
+    for _ in range(max(repeat, 1)):
+        baseline_lst.append(run([sys.executable, "-c", "pass"])[0])
+        elapsed, _, modules = run(probe_lst)[1].partition(" ")
+        import_lst.append(float(elapsed))
+        loaded.update(i for i in modules.split(",") if i)
+    median = lambda lst: sorted(lst)[len(lst) // 2]
+    import_ms = median(import_lst) * 1000
+    print("interpreter startup: {:.1f}ms, import zbx_runctl: {:.1f}ms (budget {:.1f}ms, {:.1f}ms without bytecode cache), "
+        "eagerly loaded: {!s}".format(median(baseline_lst) * 1000, import_ms, budget_ms, source_time * 1000,
+        ", ".join(sorted(loaded)) or "-"))
+    return import_ms <= budget_ms and not loaded
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark zbx_runctl against synthetic configs and a fake service manager")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="comma separated config line counts")
+    parser.add_argument("--modes", default="check,edit,status,restart", help="comma separated zbx_runctl modes")
+    parser.add_argument("--userparameters", type=float, default=0.2, help="UserParameter count, or a ratio of lines when < 1")
+    parser.add_argument("--includes", type=int, default=0, help="number of Include files")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds each fake tool call sleeps")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario")
+    parser.add_argument("--json", action="store_true", help="print JSON lines instead of a table")
+    parser.add_argument("--import-budget", type=float, default=0, help="only check the cold import time against this budget in ms")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_worker(args)
+    if args.import_budget:
+        sys.exit(0 if check_import_budget(args.import_budget, args.repeat if args.repeat > 1 else 5) else 1)
+
+    workdir = tempfile.mkdtemp(prefix="zbx_runctl_bench.")
+    try:
+        os.makedirs(os.path.join(workdir, "bin"))
+        os.makedirs(os.path.join(workdir, "state"))
+        install_fake_tools(os.path.join(workdir, "bin"))
+        # 服务初始为运行状态
+        open(os.path.join(workdir, "state", "zabbix-agent"), "w").close()
+        result_lst = []
+        for size in [int(i) for i in args.sizes.split(",") if i.strip()]:
+            userparameters = int(size * args.userparameters) if args.userparameters < 1 else int(args.userparameters)
+            for mode in [i.strip() for i in args.modes.split(",") if i.strip()]:
+                for _ in range(args.repeat):
+                    res = run_scenario(workdir, mode, size, userparameters, args.includes, args.latency)
+                    result_lst.append(res)
+                    if args.json:
+                        print(json.dumps(res, sort_keys=True))
+                        sys.stdout.flush()
+        if not args.json:
+            print(format_table(result_lst))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
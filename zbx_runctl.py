@@ -3,29 +3,63 @@
 
 # Author: AcidGo
 # Usage:
+#   参数由 easyops 平台以 INPUT_<NAME> 全局变量注入，也可以在命令行中以 --<name> 传入，如：
+#       python -m zbx_runctl status --json
+#       python zbx_runctl.py edit --zbx-cnf-server 10.0.0.1 --zbx-cnf-hostname @@
+#   高频调用时建议使用 python -m zbx_runctl，可以复用字节码缓存，直接运行脚本文件每次都需要编译。
+#   json: 为 yes 时（命令行为 --json）在标准输出打印一行 JSON 结果，包含 mode、ok、rc、elapsed 与 result。
+#   log_level / log_file: 日志级别（默认 debug）与日志文件（为空时输出至标准错误）。
 #   mode: 执行模式，可选如下：
 #       - edit: 修改配置模式，可以对指定配置进行修改。
 #       - start: 启动 agent。
 #       - restart: 重启 agent。
 #       - stop: 停止 agent。
-#       - status: 查看 agent 状态。
-#       - check: 检查 agent 配置。
+#       - status: 查看 agent 状态，并输出有效配置的指纹（fingerprint）。
+#       - check: 检查 agent 配置并做语义校验，输出 path:lineno 形式的诊断信息与 JSON 结果，
+#               存在 error 时退出码为 2。
+#       - sync-userparams: 按清单文件同步 UserParameter，新增、修改并删除清单外的条目。
+#       - probe: 通过 ZBXD 协议并发请求本机 agent 的监控项（probe_keys），输出各监控项的耗时。
+#       - serve: 常驻运行，通过 Unix socket（serve_socket）接收 JSON 请求：
+#               {"mode": "status|check|edit|restart", "params": {"Server": "..."}}
+#       - rollback: 撤销最近 rollback_generation 次修改（包括写入 Include 引入的文件的部分）并重启 agent，校验失败时恢复。
+#       - tune: 根据 CPU、内存、UserParameter 数量与实测的监控项耗时，按 tune_profile 推荐
+#               StartAgents、BufferSize、BufferSend、Timeout、RefreshActiveChecks 等性能参数，
+#               输出差异并以事务方式修改。
 #   zbx_cnf_server: 修改 zabbix-agent 关于 Server 的配置。
 #   zbx_cnf_activeserver: 修改 zabbix-agent 关于 ServerActive 的配置。
 #   zbx_cnf_hostname: 修改 zabbix-agent 关于 Hostname 的配置。
 #   zbx_cnf_listenport: 修改 zabbix-agent 关于 ListenPort 的配置。
 #   zbx_cnf_logpath: 修改 zabbix-agent 关于 LogFile 的配置。
+#   userparameter_manifest: sync-userparams 模式下的清单文件，每行一个 key,command 或 JSON。
+#   userparameter_target: sync-userparams 模式下同步的目标文件，默认为 agent 主配置，可指定 Include 的独立文件。
+#   fleet 模式（在控制端执行）：
+#       fleet_mode: 在每台主机上执行的模式。
+#       fleet_inventory: 主机清单文件，每行一个主机或 JSON 列表。
+#       fleet_transport: ssh（默认）或 local。
+#       fleet_concurrency / fleet_timeout / fleet_retries: 并发数、单主机超时与重试次数。
+#       fleet_wave_size / fleet_max_failure_rate: 每批主机数，以及超过后停止后续批次的失败率。
+#       fleet_remote_python / fleet_remote_script: 目标主机上的解释器与脚本路径，
+#           默认 ssh 使用 FLEET_REMOTE_PYTHON 与 FLEET_REMOTE_SCRIPT，local 使用当前解释器与当前脚本。
+#   drift 模式（在控制端执行）：比较各主机有效配置的指纹与期望状态，只输出存在差异的主机，存在差异时退出码为 2。
+#       drift_fingerprints: 指纹文件，即 fleet_mode 为 status 时 fleet 模式输出的 JSON lines。
+#       drift_spec: 期望状态，JSON 对象，如 {"Server": "10.0.0.1", "Timeout": "3", "UserParameter": ["k,cmd"]}。
+#       drift_inventory: 将存在差异的主机写入该文件，可作为 fleet_inventory 只对这些主机执行 edit/restart。
+#   probe_keys: probe 模式下逗号分隔的监控项 key，默认为 agent.ping。
+#   metrics_file: 指标汇总的输出文件，为空时以 JSON 写入日志。
+#   metrics_format: json（默认）或 trapper，trapper 为 zabbix_sender -i 的输入格式。
+#   metrics_host: trapper 格式中的主机名，默认为 -，即使用 agent 配置中的 Hostname。
+#   instances: 多实例模式，all 或逗号分隔的服务名称，对 start/stop/restart/status/edit 并发执行。
+#   rollback_generation: rollback 模式下撤销的修改次数，默认为 1，即恢复到最近一次修改前的配置。
+#   tune_profile: tune 模式的配置档，见 ZBX_TUNE_PROFILES，默认为 balanced。
+#   tune_dry_run: tune 模式下为 yes 时只输出差异，不修改配置。
 
 
-import platform, sys, os, time
+# 只导入启动必需的模块，平台相关或较重的模块（platform、subprocess、win32serviceutil 等）
+# 在用到时才导入，以降低 status 等高频调用的启动开销
+import sys, os, time
 import logging
 import re
-import subprocess
-
-
-if platform.system().lower() == "windows":
-    import win32serviceutil
-    import shutil
+from collections import namedtuple
 
 
 # CONFIG
@@ -38,6 +72,55 @@ ZBX_LNX_AGENTD_SERVICE_NAME = "zabbix-agent"
 ZBX_LNX_AGENT2_SERVICE_NAME = "zabbix-agent2"
 ZBX_LNX_AGENTD_CONF_PATH = "/etc/zabbix/zabbix_agentd.conf"
 ZBX_LNX_AGENT2_CONF_PATH = "/etc/zabbix/zabbix_agent2.conf"
+# 被动检查客户端：默认端口、单次请求超时秒数，以及 probe 模式的并发数
+ZBX_AGENT_DEFAULT_PORT = 10050
+ZBX_GET_TIMEOUT = 3
+ZBX_PROBE_WORKERS = 8
+# 事务式修改：重启后等待 agent 恢复运行并在端口上应答的最长秒数，超时则自动回滚
+ZBX_EDIT_VERIFY_TIMEOUT = 60
+# tune 模式的配置档，未指定时使用 ZBX_TUNE_DEFAULT_PROFILE：
+#   agents_per_cpu / max_agents: StartAgents 按 CPU 数量估算的系数与上限；
+#   userparams_per_agent: 每多少个 UserParameter 增加一个被动检查进程；
+#   buffer_per_gb / max_buffer: BufferSize 按内存 GB 数估算的系数与上限；
+#   buffer_send / refresh_active: BufferSend 与 RefreshActiveChecks 的取值；
+#   min_timeout: Timeout 的下限，实际至少为最慢监控项耗时的两倍；
+#   capacity_per_cpu: agent2 插件并发数按 CPU 数量估算的系数。
+ZBX_TUNE_PROFILES = {
+    "balanced": {"agents_per_cpu": 1, "max_agents": 16, "userparams_per_agent": 20, "buffer_per_gb": 100,
+        "max_buffer": 1000, "buffer_send": 5, "refresh_active": 120, "min_timeout": 3, "capacity_per_cpu": 10},
+    "high-frequency": {"agents_per_cpu": 2, "max_agents": 32, "userparams_per_agent": 10, "buffer_per_gb": 500,
+        "max_buffer": 65535, "buffer_send": 1, "refresh_active": 60, "min_timeout": 3, "capacity_per_cpu": 50},
+    "low-footprint": {"agents_per_cpu": 0.5, "max_agents": 3, "userparams_per_agent": 50, "buffer_per_gb": 20,
+        "max_buffer": 100, "buffer_send": 10, "refresh_active": 300, "min_timeout": 5, "capacity_per_cpu": 2},
+}
+ZBX_TUNE_DEFAULT_PROFILE = "balanced"
+# agent2 中按 Plugins.<name>.System.Capacity 调整并发数的插件
+ZBX_TUNE_AGENT2_PLUGINS = ["UserParameter", "SystemRun"]
+# tune 模式下实测耗时的 UserParameter 数量上限，超过 1 秒的监控项视为慢监控项
+ZBX_TUNE_PROBE_LIMIT = 50
+ZBX_TUNE_SLOW_ITEM = 1.0
+# agent 日志分析：偏移记录文件（为空时使用 ZBX_STATE_DIR 下的 log_state.json）、单次最多读取的字节数，以及每类保留的日志行数
+ZBX_LOG_STATE_PATH = ""
+ZBX_LOG_READ_LIMIT = 4 * 1024 * 1024
+ZBX_LOG_SAMPLE_COUNT = 3
+# 多实例模式下并发处理的实例数量上限
+ZBX_INSTANCE_WORKERS = 4
+# fleet 模式：并发主机数、单主机超时秒数、失败重试次数，以及远端的解释器与脚本路径
+# 远端以 root 执行脚本，因此脚本须安装在 root 所有的目录中，属主不是远端用户或组与其他用户可写时拒绝执行
+FLEET_CONCURRENCY = 20
+FLEET_HOST_TIMEOUT = 120
+FLEET_RETRIES = 1
+FLEET_REMOTE_PYTHON = "python"
+FLEET_REMOTE_SCRIPT = "/usr/local/lib/zbx_runctl/zbx_runctl.py"
+# 子进程：默认超时秒数、超时后 SIGTERM 与 SIGKILL 的间隔秒数，以及保留的输出字节数上限
+COMMAND_TIMEOUT = 90
+COMMAND_KILL_GRACE = 2
+COMMAND_MAX_OUTPUT = 1024 * 1024
+# serve 模式：Unix socket 路径，以及服务状态在内存中的有效秒数
+SERVE_SOCKET_PATH = "/var/run/zbx_runctl.sock"
+SERVE_STATE_TTL = 1.0
+# serve 模式下日志偏移写回磁盘的最小间隔秒数，退出时总会写回
+SERVE_LOG_STATE_INTERVAL = 30
 
 WIN_SERVICE_STATUS_MAPPING = {
     -1: "NO_INSTALL",
@@ -56,20 +139,186 @@ LNX_SERVICE_STATUS_MAPPING = {
     600: "Running",
     99: "EL6"
 }
+# 服务状态轮询：总超时秒数、首次轮询间隔与最大间隔（指数退避）
+SERVICE_READY_TIMEOUT = 30
+SERVICE_READY_INTERVAL = 0.1
+SERVICE_READY_MAX_INTERVAL = 2
+# 修改配置前保留的历史版本数量，备份为同目录下 .zbx_runctl_backup/<文件名>.1 ~ .N，1 为最新
+# 备份放在子目录中，避免被 Include=<目录> 形式的引入误加载
+ZBX_CONF_BACKUP_COUNT = 5
+# 状态目录：存放解析缓存、日志偏移等状态文件，属主须为当前用户且组与其他用户不可写，否则不使用磁盘状态
+ZBX_STATE_DIR = "/var/lib/zbx_runctl"
+# 配置文件解析结果的磁盘缓存路径，按 (path, inode, size, mtime) 失效，为空时使用 ZBX_STATE_DIR 下的 parse_cache.json
+ZBX_CONF_PARSE_CACHE_PATH = ""
 # EOF CONFIG
 
 
 
+_monotonic = getattr(time, "monotonic", time.time)
+
+
+class Metrics(object):
+    """记录执行过程中各阶段、子进程与文件读写的耗时，用于汇总分析。
+    线程安全，多实例模式下的并发调用会记录在同一个 Metrics 中。
+    """
+    def __init__(self):
+        import threading
+        self.begin = time.time()
+        self._begin = _monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.spans = []
+        self.subprocesses = []
+        self.file_io = []
+
+    def span(self, name):
+        """返回一个上下文管理器，记录 with 代码块的耗时，嵌套时记录父阶段。
+        """
+        from contextlib import contextmanager
+
+        @contextmanager
+        def _span():
+            stack = self._local.__dict__.setdefault("stack", [])
+            parent = stack[-1] if stack else None
+            stack.append(name)
+            begin = _monotonic()
+            error = None
+            try:
+                yield
+            except BaseException as e:
+                # exit(0) 属于正常结束
+                if not (isinstance(e, SystemExit) and not e.code):
+                    error = e.__class__.__name__
+                raise
+            finally:
+                stack.pop()
+                with self._lock:
+                    self.spans.append({"name": name, "parent": parent, "start": round(begin - self._begin, 6),
+                        "duration": round(_monotonic() - begin, 6), "error": error})
+        return _span()
+
+    def reset(self):
+        """清空已记录的数据，常驻进程中用于避免无限增长。
+        """
+        with self._lock:
+            self.begin = time.time()
+            self._begin = _monotonic()
+            self.spans = []
+            self.subprocesses = []
+            self.file_io = []
+
+    def record_subprocess(self, command_lst, rc, duration, output_bytes):
+        with self._lock:
+            self.subprocesses.append({"argv": list(command_lst), "rc": rc, "duration": round(duration, 6), "output_bytes": output_bytes})
+
+    def record_io(self, op, path, nbytes, duration):
+        with self._lock:
+            self.file_io.append({"op": op, "path": path, "bytes": nbytes, "duration": round(duration, 6)})
+
+    def summary(self):
+        """汇总结果，phases 按阶段名称聚合，同时保留所有明细。
+        """
+        phase_dict = {}
+        for i in self.spans:
+            phase = phase_dict.setdefault(i["name"], {"count": 0, "duration": 0.0, "errors": 0})
+            phase["count"] += 1
+            phase["duration"] = round(phase["duration"] + i["duration"], 6)
+            phase["errors"] += 1 if i["error"] else 0
+        return {
+            "begin": self.begin,
+            "duration": round(_monotonic() - self._begin, 6),
+            "phases": phase_dict,
+            "spans": self.spans,
+            "subprocess": {
+                "count": len(self.subprocesses),
+                "duration": round(sum(i["duration"] for i in self.subprocesses), 6),
+                "output_bytes": sum(i["output_bytes"] for i in self.subprocesses),
+                "calls": self.subprocesses,
+            },
+            "file_io": {
+                "count": len(self.file_io),
+                "duration": round(sum(i["duration"] for i in self.file_io), 6),
+                "bytes": sum(i["bytes"] for i in self.file_io),
+                "calls": self.file_io,
+            },
+        }
+
+    def trapper_lines(self, host="-"):
+        """生成 zabbix_sender -i 可读取的数据行：<host> <key> <value>，host 为 - 时使用 agent 配置中的 Hostname。
+        """
+        summary = self.summary()
+        line_lst = [
+            "{!s} zbx_runctl.duration {!s}".format(host, summary["duration"]),
+            "{!s} zbx_runctl.subprocess.count {!s}".format(host, summary["subprocess"]["count"]),
+            "{!s} zbx_runctl.subprocess.duration {!s}".format(host, summary["subprocess"]["duration"]),
+            "{!s} zbx_runctl.file_io.bytes {!s}".format(host, summary["file_io"]["bytes"]),
+            "{!s} zbx_runctl.file_io.duration {!s}".format(host, summary["file_io"]["duration"]),
+        ]
+        for name in sorted(summary["phases"]):
+            line_lst.append("{!s} zbx_runctl.phase.duration[{!s}] {!s}".format(host, name, summary["phases"][name]["duration"]))
+        return line_lst
+
+
+_METRICS = None
+
+def get_metrics():
+    """获取当前进程共享的 Metrics。
+    """
+    global _METRICS
+    if _METRICS is None:
+        _METRICS = Metrics()
+    return _METRICS
+
+def traced(name):
+    """装饰器：将函数的执行记录为名为 name 的阶段。
+    """
+    from functools import wraps
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def emit_metrics(metrics_file=None, metrics_format="json", host="-"):
+    """输出指标汇总。未指定 metrics_file 时以 JSON 写入日志。
+
+    Args:
+        metrics_file: 输出文件路径。
+        metrics_format: json，或 trapper（zabbix_sender -i 的输入格式）。
+        host: trapper 格式中的主机名。
+    """
+    import json
+    metrics = get_metrics()
+    if not metrics_file:
+        logging.info("metrics: {!s}".format(json.dumps(metrics.summary(), sort_keys=True)))
+        return
+    if metrics_format == "trapper":
+        content = "\n".join(metrics.trapper_lines(host)) + "\n"
+    else:
+        content = json.dumps(metrics.summary(), sort_keys=True) + "\n"
+    with open(metrics_file, "w") as f:
+        f.write(content)
+
+def read_config_text(path):
+    """读取配置类文本文件，并记录文件读取的字节数与耗时。
+    """
+    begin = _monotonic()
+    with open(path, "r") as f:
+        content = f.read()
+    get_metrics().record_io("read", path, len(content), _monotonic() - begin)
+    return content
+
 def init_logger(level, logfile=None):
     """日志功能初始化。
     如果使用日志文件记录，那么则默认使用 RotatinFileHandler 的大小轮询方式，
     默认每个最大 10 MB，最多保留 5 个。
     Args:
         level: 设定的最低日志级别。
-        logfile: 设置日志文件路径，如果不设置则表示将日志输出于标准输出。
+        logfile: 设置日志文件路径，如果不设置则表示将日志输出于标准错误，标准输出留给 --json 的结果。
     """
-    import os
-    import sys
     if not logfile:
         logging.basicConfig(
             level = getattr(logging, level.upper()),
@@ -81,12 +330,14 @@ def init_logger(level, logfile=None):
         logger.setLevel(getattr(logging, level.upper()))
         if logfile.lower() == "local":
             logfile = os.path.join(sys.path[0], os.path.basename(os.path.splitext(__file__)[0]) + ".log")
+        from logging.handlers import RotatingFileHandler
         handler = RotatingFileHandler(logfile, maxBytes=10*1024*1024, backupCount=5)
         formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
         handler.setFormatter(formatter)
         logger.addHandler(handler)
     logging.info("Logger init finished.")
 
+@traced("collect_agent")
 def collect_zabbix_agent():
     """对当前操作系统检查是否存在 Zabbix-Agent，并且判断可用的是 Agentd 还是 Agent2。
 
@@ -96,7 +347,7 @@ def collect_zabbix_agent():
             1: 存在 agentd。
             2: 存在 agent2。
     """
-    os_system = platform.system().lower()
+    os_system = get_host_facts().os_system
     # windows not allow agent2 now
     # TODO: support agent2 on windows
     if os_system == "windows":
@@ -105,9 +356,11 @@ def collect_zabbix_agent():
         else:
             return 0
     elif os_system == "linux":
-        if lnx_service_action("is-enabled", ZBX_LNX_AGENT2_SERVICE_NAME):
+        state_dict = lnx_query_service_states([ZBX_LNX_AGENT2_SERVICE_NAME, ZBX_LNX_AGENTD_SERVICE_NAME])
+        get_host_facts().service_states.update(state_dict)
+        if state_dict[ZBX_LNX_AGENT2_SERVICE_NAME].enabled:
             return 2
-        elif lnx_service_action("is-enabled", ZBX_LNX_AGENTD_SERVICE_NAME):
+        elif state_dict[ZBX_LNX_AGENTD_SERVICE_NAME].enabled:
             return 1
         else:
             return 0
@@ -118,7 +371,8 @@ def lnx_service_action(action, service_name):
     if action not in ("start", "stop", "restart", "status", "enable", "disable", "is-enabled"):
         raise Exception("not support the service action: {!s}".format(action))
     rc = -999
-    if get_sysversion() in ("el5", "el6"):
+    init_system = get_host_facts().init_system
+    if init_system == "sysvinit":
         if action in ("start", "stop", "restart", "status"):
             command_lst = ["service", service_name, action]
             rc = lnx_command_execute(command_lst)
@@ -133,7 +387,7 @@ def lnx_service_action(action, service_name):
             rc = lnx_command_execute(command_lst)
         else:
             rc = -999
-    elif get_sysversion() in ("el7"):
+    elif init_system == "systemd":
         command_lst = ["systemctl", action, service_name]
         rc = lnx_command_execute(command_lst)
     else:
@@ -149,6 +403,7 @@ def win_service_status(service_name):
     Returns:
         <int>: 返回状态码，-1 为未注册，其他可见 WIN_SERVICE_STATUS_MAPPING。
     """
+    import win32serviceutil
     try:
         status_code = win32serviceutil.QueryServiceStatus(service_name)[1]
     except Exception as e:
@@ -158,26 +413,118 @@ def win_service_status(service_name):
             raise e
     return status_code
 
-def win_service_restart(service_name):
-    """
-    """
-    win32serviceutil.RestartService(service_name)
-    time.sleep(3)
-    return win_service_status(service_name) in (4,)
+class HostFacts(object):
+    """当前主机的基础信息，每个进程只探测一次，由各服务与配置逻辑共享。
+    探测过程只读取 /etc/os-release、/etc/redhat-release 与 /proc，不派生子进程。
 
-def win_service_start(service_name):
-    """
+    Attributes:
+        os_system: 操作系统名称的小写形式，如 linux、windows，同 platform.system()。
+        sysversion: 发行版版本，如 el5、el6、el7、el8，非 RedHat 系为 None。
+        init_system: systemd、sysvinit，Windows 下为 None。
+        agent_type: 见 collect_zabbix_agent，首次访问时才检测。
+        service_states: 检测 agent_type 时批量查询到的服务状态（服务名称 -> ServiceState），
+            status 模式直接复用，不再派生子进程。
+        network: NetworkFacts，首次访问时才检测。
+        preferred_ip: 见 NetworkFacts.preferred_ip，首次访问时才检测。
+        cpu_count: 当前进程可用的 CPU 数量。
+        mem_total: 物理内存字节数，读取 /proc/meminfo，无法获取时为 None。
     """
-    win32serviceutil.StartService(service_name)
-    time.sleep(3)
-    return win_service_status(service_name) in (4,)
+    def __init__(self):
+        self.os_system = self._probe_os_system()
+        self.sysversion = None
+        self.init_system = None
+        self._agent_type = None
+        self.service_states = {}
+        self._network = None
+        self._preferred_ip = None
+        self._cpu_count = None
+        self._mem_total = None
+        if self.os_system == "linux":
+            self.sysversion = self._probe_sysversion()
+            self.init_system = "systemd" if os.path.isdir("/run/systemd/system") else "sysvinit"
 
-def win_service_stop(service_name):
-    """
+    @staticmethod
+    def _probe_os_system():
+        # 常见平台直接由 sys.platform 判断，避免导入 platform
+        if sys.platform.startswith("linux"):
+            return "linux"
+        if sys.platform.startswith("win"):
+            return "windows"
+        import platform
+        return platform.system().lower()
+
+    @staticmethod
+    def _read_file(path):
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except (IOError, OSError):
+            return ""
+
+    def _probe_sysversion(self):
+        os_release = {}
+        for line in self._read_file("/etc/os-release").splitlines():
+            if "=" in line:
+                k, v = line.split("=", 1)
+                os_release[k.strip()] = v.strip().strip("\"'")
+        id_lst = (os_release.get("ID", "") + " " + os_release.get("ID_LIKE", "")).split()
+        if set(id_lst) & set(("rhel", "centos", "fedora")):
+            tmp = re.match(r"(\d+)", os_release.get("VERSION_ID", ""))
+            if tmp:
+                return "el" + tmp.group(1)
+        tmp = re.search(r"release (\d+)", self._read_file("/etc/redhat-release"))
+        if tmp:
+            return "el" + tmp.group(1)
+        tmp = re.search(r"\.el(\d+)", self._read_file("/proc/sys/kernel/osrelease"))
+        if tmp:
+            return "el" + tmp.group(1)
+        return None
+
+    @property
+    def agent_type(self):
+        if self._agent_type is None:
+            self._agent_type = collect_zabbix_agent()
+        return self._agent_type
+
+    @property
+    def network(self):
+        if self._network is None:
+            self._network = NetworkFacts()
+        return self._network
+
+    @property
+    def preferred_ip(self):
+        if self._preferred_ip is None:
+            self._preferred_ip = self.network.preferred_ip()
+        return self._preferred_ip
+
+    @property
+    def cpu_count(self):
+        if self._cpu_count is None:
+            try:
+                self._cpu_count = len(os.sched_getaffinity(0))
+            except AttributeError:
+                import multiprocessing
+                self._cpu_count = multiprocessing.cpu_count()
+        return self._cpu_count
+
+    @property
+    def mem_total(self):
+        if self._mem_total is None:
+            tmp = re.search(r"^MemTotal:\s+(\d+) kB", self._read_file("/proc/meminfo"), re.M)
+            self._mem_total = int(tmp.group(1)) * 1024 if tmp else 0
+        return self._mem_total or None
+
+
+_HOST_FACTS = None
+
+def get_host_facts():
+    """获取当前进程共享的 HostFacts，首次调用时探测。
     """
-    win32serviceutil.StopService(service_name)
-    time.sleep(3)
-    return win_service_status(service_name) in (1,2,3)
+    global _HOST_FACTS
+    if _HOST_FACTS is None:
+        _HOST_FACTS = HostFacts()
+    return _HOST_FACTS
 
 def get_sysversion():
     """获取当前操作系统的版本信息。
@@ -186,289 +533,2580 @@ def get_sysversion():
         <str> "win": 所有 windows 平台。
         <str> "el5": CentOS/RedHat 5。
         <str> "el6": CentOS/RedHat 6。
-        <str> "el7": CentOS/RedHat 7。
+        <str> "el7": CentOS/RedHat 7，更高版本依此类推。
+        <None>: 无法识别的 Linux 发行版，服务管理依据 init_system 判断。
     """
-    if platform.system().lower() == "windows":
+    facts = get_host_facts()
+    if facts.os_system == "windows":
         return "win"
-    elif platform.system().lower() == "linux":
-        res_tmp = subprocess.check_output(["uname", "-r"]).strip()
-        res = re.search('el[0-9]', res_tmp).group()
-        if res:
-            return res
+    return facts.sysversion
+
+def _kill_command(p, sig):
+    """向子进程所在的进程组发送信号，进程组已不存在时忽略。
+    """
+    try:
+        if os.name == "posix":
+            os.killpg(p.pid, sig)
+        else:
+            p.kill()
+    except OSError:
+        pass
+
+def run_command(command_lst, timeout=None, max_output=None, merge_stderr=True):
+    """执行命令，子进程在独立的进程组中运行，超时后先 SIGTERM 再 SIGKILL 整个进程组。
+    标准输出与标准错误由后台线程边读边丢弃，只保留最后 max_output 字节。
+
+    Args:
+        command_lst: 命令列表，shell 下命令的空格分段形式。
+        timeout: 超时秒数，默认使用 COMMAND_TIMEOUT，0 表示不限制。
+        max_output: 每个输出流保留的字节数上限，默认使用 COMMAND_MAX_OUTPUT。
+        merge_stderr: 是否将标准错误合并至标准输出。
+    Returns:
+        <dict>: 包含 argv、rc、output、error、duration、timed_out、truncated，
+            被信号终止时 rc 为负数。
+    """
+    import signal
+    import subprocess
+    import threading
+    timeout = COMMAND_TIMEOUT if timeout is None else timeout
+    max_output = COMMAND_MAX_OUTPUT if max_output is None else max_output
+    res = {"argv": list(command_lst), "rc": None, "output": "", "error": "", "duration": 0.0,
+        "timed_out": False, "truncated": False}
+    kwargs = {}
+    if os.name == "posix":
+        if sys.version_info[0] >= 3:
+            kwargs["start_new_session"] = True
         else:
-            logging.error("Cannot get sysversion from [{!s}].".format(res_tmp))
-            raise Exception()
+            kwargs["preexec_fn"] = os.setsid
+    begin = _monotonic()
+    with open(os.devnull, "rb") as devnull:
+        p = subprocess.Popen(command_lst, stdin=devnull, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE, **kwargs)
+    stream_lst = [p.stdout] if merge_stderr else [p.stdout, p.stderr]
+    buffer_lst = [{"chunks": [], "size": 0, "total": 0} for _ in stream_lst]
+
+    def drain(stream, buf):
+        fd = stream.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError:
+                break
+            if not chunk:
+                break
+            buf["chunks"].append(chunk)
+            buf["size"] += len(chunk)
+            buf["total"] += len(chunk)
+            while buf["chunks"] and buf["size"] - len(buf["chunks"][0]) >= max_output:
+                buf["size"] -= len(buf["chunks"].pop(0))
+
+    def expire():
+        if p.poll() is not None:
+            return
+        res["timed_out"] = True
+        _kill_command(p, signal.SIGTERM)
+        timer_lst.append(threading.Timer(COMMAND_KILL_GRACE, _kill_command, (p, getattr(signal, "SIGKILL", signal.SIGTERM))))
+        timer_lst[-1].start()
+
+    reader_lst = [threading.Thread(target=drain, args=(stream, buf)) for stream, buf in zip(stream_lst, buffer_lst)]
+    for reader in reader_lst:
+        reader.daemon = True
+        reader.start()
+    timer_lst = []
+    if timeout:
+        timer_lst.append(threading.Timer(timeout, expire))
+        timer_lst[0].start()
+    try:
+        p.wait()
+    finally:
+        for timer in list(timer_lst):
+            timer.cancel()
+    res["rc"] = p.returncode
+    res["duration"] = _monotonic() - begin
+    # 后台启动的守护进程可能继承了输出管道，子进程结束后只再等待片刻，不等待管道关闭
+    for reader in reader_lst:
+        reader.join(0.5)
+    output_lst = []
+    for buf in buffer_lst:
+        data = b"".join(buf["chunks"])[-max_output:] if max_output else b""
+        res["truncated"] = res["truncated"] or buf["total"] > len(data)
+        output_lst.append(data.decode("utf-8", "replace") if not isinstance(data, str) else data)
+    res["output"] = output_lst[0]
+    res["error"] = output_lst[1] if len(output_lst) > 1 else ""
+    get_metrics().record_subprocess(command_lst, p.returncode, res["duration"], sum(i["total"] for i in buffer_lst))
+    if res["timed_out"]:
+        logging.warning("the command {!s} is killed after {!s}s".format(command_lst, timeout))
+    return res
 
-def lnx_command_execute(command_lst):
+def lnx_command_execute(command_lst, timeout=None):
     """在 Linux 平台执行命令。
     Args:
         command_lst: 命令列表，shell 下命令的空格分段形式。
+        timeout: 超时秒数，见 run_command。
     Returns:
-        <bool> False: 执行返回非预期 exitcode。
+        <bool> False: 执行返回非预期 exitcode 或超时。
         <bool> True: 执行返回预期 exitcode。
     """
     logging.info("---------- {!s} ----------".format(command_lst))
-    try:
-        res = subprocess.check_output(command_lst, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        for i in e.output.split('\n'):
-            logging.error(i)
-        logging.info("-"*30)
-        return False
-    for i in [i for i in res.split('\n') if not i.strip()]:
-        logging.info(i)
+    res = run_command(command_lst, timeout)
+    log = logging.info if res["rc"] == 0 else logging.error
+    if res["truncated"]:
+        log("... (output truncated)")
+    for i in [i for i in res["output"].split("\n") if i.strip()]:
+        log(i)
     logging.info("-"*30)
-    return True
+    return res["rc"] == 0
 
-def multi_service_action(action, service_name):
+def lnx_command_output(command_lst, timeout=None):
+    """在 Linux 平台执行命令并获取输出，不做日志输出，用于状态轮询。
+    Args:
+        command_lst: 命令列表，shell 下命令的空格分段形式。
+        timeout: 超时秒数，见 run_command。
+    Returns:
+        <tuple> (rc, output): 命令的 exitcode 与合并后的标准输出和标准错误。
     """
+    res = run_command(command_lst, timeout)
+    return res["rc"], res["output"]
+
+
+class ServiceBackend(object):
+    """服务管理后端的接口定义。
+    状态统一归一化为 RUNNING、STOPPED、PENDING、NO_INSTALL、UNKNOWN，
+    测试时可通过 set_service_backend 替换为假的服务管理器。
     """
-    os_system = platform.system().lower()
-    if os_system in ("windows",):
-        if action == "status":
-            return win_service_status(service_name)
-        elif action == "restart":
-            return win_service_restart(service_name)
-        elif action == "start":
-            return win_service_start(service_name)
-        elif action == "stop":
-            return win_service_stop(service_name)
-        else:
+    def action(self, action, service_name):
+        """对服务下发 start/stop/restart 动作，仅下发不等待。
+
+        Returns:
+            <bool>: 动作是否被成功受理。
+        """
+        raise NotImplementedError()
+
+    def state(self, service_name):
+        """查询服务当前的归一化状态。
+
+        Returns:
+            <str>: RUNNING、STOPPED、PENDING、NO_INSTALL、UNKNOWN 之一。
+        """
+        raise NotImplementedError()
+
+
+class WinServiceBackend(ServiceBackend):
+    """基于 win32serviceutil 的 Windows 服务后端。
+    """
+    _action_mapping = {
+        "start": "StartService",
+        "stop": "StopService",
+        "restart": "RestartService",
+    }
+
+    def action(self, action, service_name):
+        if action not in self._action_mapping:
             raise Exception("not supported action {!s} for service {!s} on windows".format(action, service_name))
-    elif os_system == "linux":
+        import win32serviceutil
+        getattr(win32serviceutil, self._action_mapping[action])(service_name)
+        return True
+
+    def state(self, service_name):
+        rc = win_service_status(service_name)
+        if rc == 4:
+            return "RUNNING"
+        elif rc == 1:
+            return "STOPPED"
+        elif rc in (2, 3):
+            return "PENDING"
+        elif rc == -1:
+            return "NO_INSTALL"
+        return "UNKNOWN"
+
+
+class ServiceState(namedtuple("ServiceState", "name installed enabled active_state sub_state main_pid active_enter_timestamp")):
+    """Linux 服务的状态快照。
+
+    Attributes:
+        name: 服务名称。
+        installed: 服务是否存在。
+        enabled: 是否开机自启动。
+        active_state: systemd 的 ActiveState，sysvinit 下为 active 或 inactive。
+        sub_state: systemd 的 SubState，sysvinit 下为 running 或 dead。
+        main_pid: 主进程 PID，未运行时为 0。
+        active_enter_timestamp: 进入运行状态的时间，未运行时为空字符串。
+    """
+    __slots__ = ()
+
+    _state_mapping = {
+        "active": "RUNNING",
+        "inactive": "STOPPED",
+        "failed": "STOPPED",
+        "activating": "PENDING",
+        "deactivating": "PENDING",
+        "reloading": "PENDING",
+    }
+
+    @property
+    def state(self):
+        """归一化后的状态，取值同 ServiceBackend.state。
+        """
+        if not self.installed:
+            return "NO_INSTALL"
+        return self._state_mapping.get(self.active_state, "UNKNOWN")
+
+
+_SYSTEMD_SHOW_PROPERTIES = ("Id", "LoadState", "UnitFileState", "ActiveState", "SubState", "MainPID", "ActiveEnterTimestamp")
+# systemctl is-enabled 返回 0 的 UnitFileState
+_SYSTEMD_ENABLED_STATES = ("enabled", "enabled-runtime", "static", "indirect", "generated", "alias")
+
+def lnx_systemd_service_states(service_lst):
+    """一次 systemctl show 调用获取多个服务的状态。
+    """
+    command_lst = ["systemctl", "show"]
+    for i in _SYSTEMD_SHOW_PROPERTIES:
+        command_lst += ["-p", i]
+    unit_lst = [i if i.endswith(".service") else i + ".service" for i in service_lst]
+    _, output = lnx_command_output(command_lst + unit_lst)
+    props_dict = {}
+    for block in re.split(r"\n\s*\n", output.strip()):
+        props = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+        if props.get("Id"):
+            props_dict[props["Id"]] = props
+    res = {}
+    for service_name, unit in zip(service_lst, unit_lst):
+        props = props_dict.get(unit, {})
+        main_pid = props.get("MainPID", "0")
+        res[service_name] = ServiceState(
+            name = service_name,
+            installed = props.get("LoadState", "not-found") not in ("not-found", ""),
+            enabled = props.get("UnitFileState", "") in _SYSTEMD_ENABLED_STATES,
+            active_state = props.get("ActiveState", "inactive"),
+            sub_state = props.get("SubState", "dead"),
+            main_pid = int(main_pid) if main_pid.isdigit() else 0,
+            active_enter_timestamp = props.get("ActiveEnterTimestamp", ""),
+        )
+    return res
+
+def sysvinit_config_path(service_name):
+    """sysvinit 服务使用的 agent 配置文件路径，无法确定时返回 None。
+    先从启动脚本中获取：zabbix 自带脚本的 conf=、其他常见的 CONFIG_FILE=、CONFFILE=，以及头部的 # config: 注释；
+    获取不到时，只有默认的服务名称使用默认的配置文件。
+    """
+    try:
+        with open(os.path.join("/etc/init.d", service_name), "r") as f:
+            content = f.read()
+    except (IOError, OSError):
+        content = ""
+    for tmp in re.finditer(r"^\s*(?:conf|CONFIG_FILE|CONFFILE)=[\"']?([^\"'\s]+)|^#\s*config:\s*(\S+)", content, re.M):
+        path = tmp.group(1) or tmp.group(2)
+        # 由变量拼接的路径无法确定
+        if "$" not in path:
+            return path
+    if service_name == ZBX_LNX_AGENTD_SERVICE_NAME:
+        return ZBX_LNX_AGENTD_CONF_PATH
+    if service_name == ZBX_LNX_AGENT2_SERVICE_NAME:
+        return ZBX_LNX_AGENT2_CONF_PATH
+    return None
+
+def _read_sysvinit_pid(service_name, config_path=None):
+    script = os.path.join("/etc/init.d", service_name)
+    candidate_lst = []
+    # 优先使用 agent 配置中的 PidFile，zabbix 自带的启动脚本也是从配置中获取 pidfile 的
+    if config_path:
+        try:
+            pidfile = resolve_effective_config(config_path).get("PidFile")
+        except (IOError, OSError):
+            pidfile = None
+        if pidfile:
+            candidate_lst.append(pidfile)
+    try:
+        with open(script, "r") as f:
+            tmp = re.search(r"^\s*(?:pidfile|PIDFILE)=[\"']?([^\"'\s]+)", f.read(), re.M)
+            if tmp and "$" not in tmp.group(1):
+                candidate_lst.append(tmp.group(1))
+    except (IOError, OSError):
+        pass
+    # 默认的 pidfile 只属于默认的服务，否则多个实例会读到同一个 PID
+    if service_name in (ZBX_LNX_AGENTD_SERVICE_NAME, ZBX_LNX_AGENT2_SERVICE_NAME):
+        binary = "zabbix_agent2" if "agent2" in service_name else "zabbix_agentd"
+        candidate_lst += ["/var/run/zabbix/{!s}.pid".format(binary), "/tmp/{!s}.pid".format(binary)]
+    for pidfile in candidate_lst:
+        try:
+            with open(pidfile, "r") as f:
+                pid = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            continue
+        if os.path.exists("/proc/{!s}".format(pid)):
+            return pid
+    return 0
+
+def _proc_start_time(pid):
+    try:
+        with open("/proc/{!s}/stat".format(pid), "r") as f:
+            # comm 字段可能包含空格，从最后一个右括号之后开始切分
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat", "r") as f:
+            btime = int(re.search(r"^btime (\d+)", f.read(), re.M).group(1))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return ""
+    return time.strftime("%a %Y-%m-%d %H:%M:%S", time.localtime(btime + start_ticks / float(os.sysconf("SC_CLK_TCK"))))
+
+def lnx_sysvinit_service_states(service_lst, config_dict=None):
+    """通过启动脚本、rc 链接、pidfile 与 /proc 获取 sysvinit 服务的状态，不派生子进程。
+
+    Args:
+        service_lst: 服务名称列表。
+        config_dict: 服务名称 -> agent 配置文件路径，用于读取 PidFile，未指定的服务见 sysvinit_config_path。
+    """
+    import glob
+    res = {}
+    for service_name in service_lst:
+        config_path = (config_dict or {}).get(service_name) or sysvinit_config_path(service_name)
+        installed = os.path.isfile(os.path.join("/etc/init.d", service_name))
+        enabled = installed and bool(glob.glob("/etc/rc.d/rc[2345].d/S*{!s}".format(service_name)) or glob.glob("/etc/rc[2345].d/S*{!s}".format(service_name)))
+        pid = _read_sysvinit_pid(service_name, config_path) if installed else 0
+        res[service_name] = ServiceState(
+            name = service_name,
+            installed = installed,
+            enabled = enabled,
+            active_state = "active" if pid else "inactive",
+            sub_state = "running" if pid else "dead",
+            main_pid = pid,
+            active_enter_timestamp = _proc_start_time(pid) if pid else "",
+        )
+    return res
+
+@traced("service.query")
+def lnx_query_service_states(service_lst, config_dict=None):
+    """批量获取 Linux 服务的状态。
+
+    Args:
+        service_lst: 服务名称列表。
+        config_dict: 见 lnx_sysvinit_service_states，systemd 下不使用。
+    Returns:
+        <dict>: 服务名称 -> ServiceState。
+    """
+    if get_host_facts().init_system == "systemd":
+        return lnx_systemd_service_states(service_lst)
+    return lnx_sysvinit_service_states(service_lst, config_dict)
+
+
+class LnxServiceBackend(ServiceBackend):
+    """基于 systemctl 或 service 的 Linux 服务后端。
+    """
+    def action(self, action, service_name):
         return lnx_service_action(action, service_name)
-    else:
-        raise Exception("not suported for the os: {!s}".format(os_system))
 
+    def state(self, service_name):
+        return lnx_query_service_states([service_name])[service_name].state
+
+
+_SERVICE_BACKEND = None
+
+def set_service_backend(backend):
+    """替换当前进程使用的服务管理后端，传入 None 时恢复按操作系统自动选择。
+    """
+    global _SERVICE_BACKEND
+    _SERVICE_BACKEND = backend
+
+def get_service_backend():
+    """获取当前进程使用的服务管理后端。
+    """
+    global _SERVICE_BACKEND
+    if _SERVICE_BACKEND is None:
+        os_system = get_host_facts().os_system
+        if os_system == "windows":
+            _SERVICE_BACKEND = WinServiceBackend()
+        elif os_system == "linux":
+            _SERVICE_BACKEND = LnxServiceBackend()
+        else:
+            raise Exception("not suported for the os: {!s}".format(os_system))
+    return _SERVICE_BACKEND
+
+def wait_service_state(service_name, target, timeout=None, backend=None):
+    """轮询服务状态直至达到目标状态或超时，轮询间隔按指数退避增长。
+
+    Args:
+        service_name: 服务名称。
+        target: 目标状态，RUNNING 或 STOPPED。
+        timeout: 等待的最长秒数，默认使用 SERVICE_READY_TIMEOUT。
+        backend: 服务管理后端，默认使用 get_service_backend()。
+    Returns:
+        <dict>: 包含 ready（是否达到目标状态）、state（最后一次观察到的状态）、
+            elapsed（耗时秒数）。
+    """
+    if timeout is None:
+        timeout = SERVICE_READY_TIMEOUT
+    if backend is None:
+        backend = get_service_backend()
+    begin = _monotonic()
+    deadline = begin + timeout
+    interval = SERVICE_READY_INTERVAL
+    while True:
+        state = backend.state(service_name)
+        now = _monotonic()
+        if state == target or state == "NO_INSTALL" or now >= deadline:
+            break
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * 2, SERVICE_READY_MAX_INTERVAL)
+    return {"ready": state == target, "state": state, "elapsed": now - begin}
+
+@traced("service.transition")
+def service_transition(action, service_name, timeout=None, backend=None):
+    """对服务执行 start/stop/restart，并等待其达到对应的目标状态。
+
+    Args:
+        action: start、stop 或 restart。
+        service_name: 服务名称。
+        timeout: 等待的最长秒数，默认使用 SERVICE_READY_TIMEOUT。
+        backend: 服务管理后端，默认使用 get_service_backend()。
+    Returns:
+        <dict>: 在 wait_service_state 的返回基础上增加 action 与 service。
+    """
+    if backend is None:
+        backend = get_service_backend()
+    target = "STOPPED" if action == "stop" else "RUNNING"
+    begin = _monotonic()
+    metrics = get_metrics()
+    with metrics.span("service.action"):
+        if not backend.action(action, service_name):
+            logging.error("the service {!s} refused action {!s}".format(service_name, action))
+    with metrics.span("service.wait"):
+        res = wait_service_state(service_name, target, timeout, backend)
+    res["elapsed"] = _monotonic() - begin
+    res["action"] = action
+    res["service"] = service_name
+    logging.info("{!s} {!s}: state {!s} after {:.2f}s".format(action, service_name, res["state"], res["elapsed"]))
+    return res
+
+def _ip_to_int(ip):
+    import socket
+    import struct
+    return struct.unpack("!L", socket.inet_aton(ip))[0]
+
+def _int_to_ip(value):
+    import socket
+    import struct
+    return socket.inet_ntoa(struct.pack("!L", value))
+
+def _route_hex_to_int(value):
+    import struct
+    # /proc/net/route 中的地址为主机字节序（小端）的十六进制
+    return struct.unpack("!L", struct.pack("<L", int(value, 16)))[0]
+
+
+class NetworkFacts(object):
+    """当前主机的 IPv4 地址与路由信息。
+    Linux 下一次读取 /proc/net/route 与 /proc/net/fib_trie，不派生子进程，
+    fib_trie 不可用时退化为一次 SIOCGIFCONF 调用。
+
+    Attributes:
+        routes: (iface, destination, mask, gateway) 列表，地址均为整数。
+        addresses: (iface, ip, mask) 列表，不包含回环地址，iface 与 mask 可能为 None。
+        default_gateway: 默认网关整数，没有时为 None。
+        default_iface: 默认路由所在的网卡，没有时为 None。
+    """
+    def __init__(self):
+        self.routes = []
+        self.addresses = []
+        self.default_gateway = None
+        self.default_iface = None
+        if get_host_facts().os_system == "linux":
+            self._probe_routes()
+            ip_lst = self._probe_fib_trie() or self._probe_ifconf()
+            for ip in ip_lst:
+                iface, mask = self._match_route(ip)
+                self.addresses.append((iface, ip, mask))
+
+    def _probe_routes(self):
+        try:
+            with open("/proc/net/route", "r") as f:
+                line_lst = f.read().splitlines()[1:]
+        except (IOError, OSError):
+            return
+        for line in line_lst:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            route = (fields[0], _route_hex_to_int(fields[1]), _route_hex_to_int(fields[7]), _route_hex_to_int(fields[2]))
+            self.routes.append(route)
+            if route[1] == 0 and route[2] == 0 and self.default_gateway is None:
+                self.default_iface, self.default_gateway = route[0], route[3]
+
+    @staticmethod
+    def _probe_fib_trie():
+        res = []
+        try:
+            with open("/proc/net/fib_trie", "r") as f:
+                content = f.read()
+        except (IOError, OSError):
+            return res
+        last_ip = None
+        for line in content.splitlines():
+            line = line.strip()
+            if line.startswith("|--"):
+                last_ip = line[3:].strip()
+            elif line.startswith("/32 host LOCAL") and last_ip:
+                ip = _ip_to_int(last_ip)
+                if ip >> 24 != 127 and ip not in res:
+                    res.append(ip)
+        return res
+
+    @staticmethod
+    def _probe_ifconf():
+        import array
+        import fcntl
+        import socket
+        import struct
+        ifreq_size = 40 if struct.calcsize("P") == 8 else 32
+        max_bytes = ifreq_size * 128
+        buf = array.array("B", b"\0" * max_bytes)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            out = fcntl.ioctl(s.fileno(), 0x8912, struct.pack("iL", max_bytes, buf.buffer_info()[0]))
+        except (IOError, OSError):
+            return []
+        finally:
+            s.close()
+        out_bytes = struct.unpack("iL", out)[0]
+        data = buf.tobytes() if hasattr(buf, "tobytes") else buf.tostring()
+        res = []
+        for i in range(0, out_bytes, ifreq_size):
+            ip = _ip_to_int(socket.inet_ntoa(data[i + 20:i + 24]))
+            if ip >> 24 != 127 and ip not in res:
+                res.append(ip)
+        return res
+
+    def _match_route(self, ip):
+        # 以直连路由中掩码最长的一条作为该地址所在的网卡与网段
+        res = (None, None)
+        for iface, destination, mask, gateway in self.routes:
+            if gateway != 0 or mask == 0 or ip & mask != destination:
+                continue
+            if res[1] is None or mask > res[1]:
+                res = (iface, mask)
+        return res
+
+    def preferred_ip(self):
+        """选择与默认网关处于同一网段的地址，多个时优先默认路由所在的网卡。
+        没有网关或无法匹配时，若只有一个地址则返回该地址。
+
+        Returns:
+            <str>: IP 地址，无法确定时为 None。
+        """
+        if self.default_gateway is not None:
+            match_lst = [i for i in self.addresses if i[2] is not None and i[1] & i[2] == self.default_gateway & i[2]]
+            match_lst.sort(key=lambda i: i[0] != self.default_iface)
+            if match_lst:
+                return _int_to_ip(match_lst[0][1])
+        if len(self.addresses) == 1:
+            return _int_to_ip(self.addresses[0][1])
+        return None
+
+
+@traced("network.preferred_ip")
 def get_preferred_ipaddres():
     """选择合适的当期主机内的 IP 地址。
     如果是 easyops 版本，则首先使用 EASYOPS_LOCAL_IP 变量；
-    如果是非 easyops 版本，将使用报文协议获取所有IP，然后选择默认网关同网段的IP地址返回。
+    如果是非 easyops 版本，将选择与默认网关同网段的IP地址返回，结果缓存于 HostFacts。
     Returns:
         <str> ip: 合适的IP地址，可能返回 None。
     """
     if "EASYOPS_LOCAL_IP" in globals() and globals().get("EASYOPS_LOCAL_IP") != "":
         return EASYOPS_LOCAL_IP
+    return get_host_facts().preferred_ip
 
-    import socket
-    import fcntl
+class ZbxdError(Exception):
+    """ZBXD 协议请求失败。
+
+    Attributes:
+        kind: connect（无法建立连接）、timeout（请求超时）或 protocol（连接已建立但响应异常）。
+    """
+    def __init__(self, kind, message):
+        Exception.__init__(self, message)
+        self.kind = kind
+
+
+_ZBXD_HEADER = b"ZBXD"
+_ZBXD_FLAG_PROTOCOL = 0x01
+_ZBXD_FLAG_COMPRESSED = 0x02
+_ZBXD_FLAG_LARGE = 0x04
+
+def zbxd_pack(data, compress=False):
+    """按 ZBXD 协议封装数据：ZBXD、flags、数据长度与保留字段（压缩时为原始长度）。
+    """
     import struct
-    from sys import version_info
+    import zlib
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    flags = _ZBXD_FLAG_PROTOCOL
+    reserved = 0
+    if compress:
+        reserved = len(data)
+        data = zlib.compress(data)
+        flags |= _ZBXD_FLAG_COMPRESSED
+    return _ZBXD_HEADER + struct.pack("<BII", flags, len(data), reserved) + data
 
-    def get_ip_address(ifname):
-        """
-        """
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if version_info.major == 3:
-            ifname_ = bytes(ifname[:15], "utf-8")
+def _recv_exact(sock, size):
+    chunk_lst = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ZbxdError("protocol", "connection closed by peer")
+        chunk_lst.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunk_lst)
+
+def zbxd_recv(sock):
+    """从 socket 读取一个 ZBXD 数据包，支持压缩与大包格式。
+
+    Returns:
+        <bytes>: 解压后的数据。
+    """
+    import struct
+    import zlib
+    header = _recv_exact(sock, 5)
+    if header[:4] != _ZBXD_HEADER:
+        raise ZbxdError("protocol", "bad header {!r}".format(header))
+    flags = bytearray(header[4:5])[0]
+    if flags & _ZBXD_FLAG_LARGE:
+        datalen, reserved = struct.unpack("<QQ", _recv_exact(sock, 16))
+    else:
+        datalen, reserved = struct.unpack("<II", _recv_exact(sock, 8))
+    data = _recv_exact(sock, datalen)
+    if flags & _ZBXD_FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+    return data
+
+def zabbix_get(key, host="127.0.0.1", port=None, timeout=None, compress=False):
+    """向 agent 发送一次被动检查请求。
+
+    Args:
+        key: 监控项 key，如 agent.ping。
+        host: agent 地址。
+        port: agent 端口，默认使用 ZBX_AGENT_DEFAULT_PORT。
+        timeout: 超时秒数，默认使用 ZBX_GET_TIMEOUT。
+        compress: 是否以压缩格式发送请求。
+    Returns:
+        <dict>: 包含 key、ok、value、error、kind、latency，ok 为 False 时 kind 为 ZbxdError.kind
+            或 notsupported。
+    """
+    import socket
+    port = port or ZBX_AGENT_DEFAULT_PORT
+    timeout = timeout or ZBX_GET_TIMEOUT
+    res = {"key": key, "ok": False, "value": None, "error": "", "kind": "", "latency": 0.0}
+    begin = _monotonic()
+    sock = None
+    try:
+        try:
+            sock = socket.create_connection((host, port), timeout)
+        except socket.timeout:
+            raise ZbxdError("connect", "connect to {!s}:{!s} timed out".format(host, port))
+        except socket.error as e:
+            raise ZbxdError("connect", "connect to {!s}:{!s} failed: {!s}".format(host, port, e))
+        try:
+            sock.sendall(zbxd_pack(key, compress))
+            data = zbxd_recv(sock)
+        except socket.timeout:
+            raise ZbxdError("timeout", "request {!s} timed out".format(key))
+        except socket.error as e:
+            raise ZbxdError("protocol", str(e))
+        value = data.decode("utf-8", "replace")
+        if value.startswith("ZBX_NOTSUPPORTED"):
+            res["kind"] = "notsupported"
+            res["error"] = value[len("ZBX_NOTSUPPORTED"):].strip("\0") or "not supported"
         else:
-            ifname_ = ifname[:15]
-        return socket.inet_ntoa(fcntl.ioctl(
-            s.fileno(),
-            0x8915,
-            struct.pack('256s', ifname_)
-        )[20:24])
-
-    ip_lst = []
-    for net in list_all_netcards():
-        ip_lst.append(get_ip_address(net))
-    if len(ip_lst) == 0:
-        return None
-    if len(ip_lst) == 2 and '127.0.0.1' in ip_lst:
-        return ip_lst[2 - ip_lst.index("127.0.0.1")]
-    gateway = get_default_gateway()
-    if not gateway:
-        return None
-    gateway_prefix = '.'.join(gateway.split('.')[0:-1])
-    res = None
-    for i in ip_lst:
-        if i.startswith(gateway_prefix):
-            res = i
-            break
+            res["ok"] = True
+            res["value"] = value
+    except ZbxdError as e:
+        res["kind"] = e.kind
+        res["error"] = str(e)
+    finally:
+        if sock is not None:
+            sock.close()
+    res["latency"] = round(_monotonic() - begin, 6)
     return res
 
-def get_zbx_agent_config_path(os_system, agent_type):
+def probe_agent_items(key_lst, host="127.0.0.1", port=None, timeout=None, workers=None):
+    """并发请求多个监控项，用于测量各监控项（如 UserParameter）的响应耗时。
+
+    Returns:
+        <list>: 与 key_lst 顺序一致的 zabbix_get 结果列表。
     """
+    from multiprocessing.pool import ThreadPool
+    if not key_lst:
+        return []
+    pool = ThreadPool(min(workers or ZBX_PROBE_WORKERS, len(key_lst)))
+    try:
+        return pool.map(lambda key: zabbix_get(key, host, port, timeout), key_lst)
+    finally:
+        pool.close()
+        pool.join()
+
+def agent_endpoint(config_path):
+    """从有效配置中获取本机 agent 的被动检查地址与端口。
+
+    Returns:
+        <tuple>: (host, port)。
     """
-    if os_system == "windows":
-        if agent_type in (1, 2):
-            return ZBX_WIN_AGENTD_CONF_PATH
-    if os_system == "linux":
-        if agent_type == 1:
-            return ZBX_LNX_AGENTD_CONF_PATH
-        elif agent_type == 2:
-            return ZBX_LNX_AGENT2_CONF_PATH
+    effective = resolve_effective_config(config_path)
+    port = effective.get("ListenPort") or ZBX_AGENT_DEFAULT_PORT
+    host = (effective.get("ListenIP") or "").split(",")[0].strip()
+    if host in ("", "0.0.0.0", "::"):
+        host = "127.0.0.1"
+    return host, int(port)
 
-def zbx_config_check(config_path):
-    """检查 zabbix-agent 配置信息。
+def wait_agent_listening(config_path, timeout=None):
+    """等待 agent 在配置的端口上接受连接，以 agent.ping 探测，间隔按指数退避增长。
+    连接已建立但被拒绝（如 Server 不包含本机）同样视为端口可用。
+    有效配置中 StartAgents=0 时 agent 只做主动检查、不监听端口，不做探测并直接返回。
 
-    Args:
-        config_path: 配置文件路径。
+    Returns:
+        <dict>: 最后一次 zabbix_get 的结果，额外包含 passive、listening 与 endpoint；
+            passive 为 False 时 listening 同样为 False，调用方只以服务状态为准。
     """
-    import re
-    if not os.path.isfile(config_path):
-        logging.error("The config:[{!s}] is not a file not not exists.".format(config_path))
-        raise Exception()
-    if not os.access(config_path, os.W_OK):
-        logging.error("The config:[{!s}] is not allow to write.".format(config_path))
-        raise Exception()
-    conf_lst = []
-    with open(config_path, "r") as f:
-        for line in f:
-            if re.search(r"^ *#", line) or re.search(r"^ *$", line):
-                continue
-            conf_lst.append(line.strip())
-    out_str = "Check the conf:[{!s}] is:\n".format(config_path)
-    out_str += "\n".join(conf_lst)
-    logging.info(out_str)
+    if resolve_effective_config(config_path).get("StartAgents") == "0":
+        return {"key": "agent.ping", "ok": False, "value": None, "error": "passive checks are disabled (StartAgents=0)",
+            "kind": "disabled", "latency": 0.0, "passive": False, "listening": False, "endpoint": ""}
+    host, port = agent_endpoint(config_path)
+    deadline = _monotonic() + (SERVICE_READY_TIMEOUT if timeout is None else timeout)
+    interval = SERVICE_READY_INTERVAL
+    while True:
+        res = zabbix_get("agent.ping", host, port)
+        res["passive"] = True
+        res["listening"] = res["kind"] != "connect"
+        res["endpoint"] = "{!s}:{!s}".format(host, port)
+        if res["listening"] or _monotonic() >= deadline:
+            return res
+        time.sleep(min(interval, max(deadline - _monotonic(), 0)))
+        interval = min(interval * 2, SERVICE_READY_MAX_INTERVAL)
 
-def zbx_config_edit(config_path, config_dict):
-    """修改 zabbix-agent 配置文件的参数。
+
+class FakeZabbixAgent(object):
+    """本地的假 agent，按 ZBXD 协议应答被动检查，用于测试。
 
     Args:
-        config_path: 需要修改的 zabbix-agent 的配置文件路径。
-        config_dict: 需要修改的参数内容。
+        items: 监控项 key -> 值，值可以是无参函数；不存在的 key 返回 ZBX_NOTSUPPORTED。
+        host: 监听地址。
+        port: 监听端口，0 表示随机端口，启动后可从 port 属性获取。
     """
-    import re
-    if len(filter(lambda x: config_dict.get(x, '') in ('', []), config_dict)) == len(config_dict):
-        logging.info("No config to edit.")
-        with open(config_path, "r") as f:
-            for line in f:
-                for i in config_dict:
-                    tmp = re.search(r"^{!s} *= *(.*?)$".format(i), line)
-                    if not tmp:
-                        continue
-                    else:
-                        logging.info("Now config: {!s}.".format(line.strip()))
-                        break
-        return 
-    if not os.path.isfile(config_path):
-        logging.error("The config:[{!s}] is not a file not not exists.".format(config_path))
-        raise Exception()
-    if not os.access(config_path, os.W_OK):
-        logging.error("The config:[{!s}] is not allow to write.".format(config_path))
-        raise Exception()
-    logging.info("Begin to chagne config.")
-    conf_lst = []
-    old_config_dict = {}
-    if config_dict.get("UserParameter", None):
-        userparameter_append = [i for i in config_dict["UserParameter"]]
-        userparameter_change = []
-        old_config_dict["UserParameter"] = []
-    with open(config_path, "r") as f:
-        for line in f:
-            for i in config_dict:
-                if not config_dict[i]:
-                    continue
-                tmp = re.search(r"^{!s} *= *(.*?)$".format(i), line)
-                if not tmp:
-                    continue
-                else:
-                    if i == "UserParameter":
-                        # 如果 config_dict["UserParameter"] 中的所有元素为空，则跳过上层 for
-                        for ii_1 in config_dict[i]:
-                            if ii_1.strip() != "":
-                                break
-                        else:
-                            continue
-                        cnf_userparameter_key = "".join(line.strip().split('=')[1:]).split(',')[0].strip()
-                        for j_value in config_dict[i]:
-                            if cnf_userparameter_key == j_value.strip().split(',')[0].strip():
-                                logging.debug("Catch userparameter_key:[{!s}].".format(cnf_userparameter_key))
-                                logging.debug("It is [{!s}].".format(line.strip()))
-                                # 如果 UserParameter 是带有 DEL 符号的，则需要删除
-                                if j_value.strip().split(',')[-1].strip() == "DEL":
-                                    logging.debug("For the userparameter_key:[{!s}], DEL it.".format(cnf_userparameter_key))
-                                    userparameter_append.remove(j_value)
-                                    line = "@@"
-                                    break
-                                else:
-                                    old_line = line
-                                    line = re.sub(r"^{!s} *= *(.*?)$".format(i), "{!s}={!s}".format(i, j_value), line)
-                                    old_config_dict[i].append(tmp.group(1))
-                                    userparameter_change.append((old_line.strip(), j_value.strip()))
-                                    userparameter_append.remove(j_value)
-                                    break
-                    else:
-                        old_config_dict[i] = tmp.group(1)
-                        line = re.sub(r"^{!s} *= *(.*?)$".format(i), "{!s}={!s}".format(i, config_dict[i]), line)
-                    break
-            if line != "@@":
-                conf_lst.append(line)
+    def __init__(self, items=None, host="127.0.0.1", port=0):
+        import socket
+        self.items = items if items is not None else {"agent.ping": "1"}
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self.host, self.port = self._server.getsockname()[:2]
+
+    def start(self):
+        import threading
+        self._server.listen(16)
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.close()
+
+    def _loop(self):
+        import socket
+        import threading
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        try:
+            key = zbxd_recv(conn).decode("utf-8").strip()
+            value = self.items.get(key)
+            if value is None:
+                data = "ZBX_NOTSUPPORTED\0Unsupported item key."
             else:
-                logging.debug("Get the special symbol:[{!s}].".format(line.strip()))
-    hassplit = 0 if conf_lst[-1].endswith(os.linesep) else 1
-    # 某些可能存在上一步未匹配得到的修改配置，这里讲追加至尾部
-    for i in config_dict:
-        if i == "UserParameter":
-            if len(filter(lambda x: x.strip() != "", userparameter_append)) > 0:
-                for j in userparameter_append:
-                    if j.strip().split(',')[-1].strip() == "DEL":
-                        continue
-                    conf_lst.append("{!s}={!s}".format(os.linesep*hassplit + i, str(j) + os.linesep))
-                    userparameter_change.append(('', "UserParameter={!s}".format(j.strip())))
-        elif i not in old_config_dict and config_dict[i]:
-            conf_lst.append("{!s}={!s}".format(os.linesep*hassplit + i, str(config_dict[i]) + os.linesep))
-            old_config_dict[i] = ""
-    with open(config_path, "w") as f:
-        for line in conf_lst:
-            f.write(line)
-    for i in old_config_dict:
-        if i != "UserParameter":
-            logging.info("Change {!s}={!s} -> {!s}".format(i, old_config_dict[i], config_dict[i]))
-        else:
-            for j in userparameter_change:
-                logging.info("Change {!s} -> {!s}".format(j[0], j[1]))
+                data = str(value() if callable(value) else value)
+            conn.sendall(zbxd_pack(data))
+        except Exception as e:
+            logging.debug("fake agent error: {!s}".format(e))
+        finally:
+            conn.close()
+
+def secure_state_path(filename, state_path=None):
+    """返回状态文件的路径，所在目录不可信时返回 None。
+    解析缓存决定了 edit 写入哪些文件，因此状态文件只存放在属主为当前 euid、且组与其他用户不可写的目录中，
+    目录不存在时以 0700 创建。
 
-def execute(mode, zbx_cnf_server, zbx_cnf_activeserver, zbx_cnf_hostname, zbx_cnf_listenport, zbx_cnf_logpath):
+    Args:
+        filename: <str>，ZBX_STATE_DIR 下的文件名
+        state_path: <str>，指定的状态文件路径，不为空时检查其所在目录
+    Returns:
+        <str|None>
     """
+    import stat
+    geteuid = getattr(os, "geteuid", None)
+    if geteuid is None:
+        return None
+    path = state_path or os.path.join(ZBX_STATE_DIR, filename)
+    state_dir = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir, 0o700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(state_dir)
+    except OSError as e:
+        logging.debug("Cannot use the state directory:[{!s}]: {!s}.".format(state_dir, e))
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        logging.warning("Ignore the untrusted state directory:[{!s}].".format(state_dir))
+        return None
+    return path
+
+
+def read_state_file(path):
+    """读取 JSON 格式的状态文件，文件不存在、属主不是当前 euid、组或其他用户可写，或者内容无效时返回空字典。
+    """
+    import json
+    import stat
+    if not path:
+        return {}
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    except OSError:
+        return {}
+    with os.fdopen(fd) as f:
+        st = os.fstat(f.fileno())
+        if st.st_uid != os.geteuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            logging.warning("Ignore the untrusted state file:[{!s}].".format(path))
+            return {}
+        try:
+            data = json.loads(f.read())
+        except ValueError:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+
+class AgentLogInspector(object):
+    """zabbix-agent 日志的增量分析。
+    按日志文件记录已读取的字节偏移与 inode，每次只 seek 到偏移处读取新增的部分，
+    inode 变化或文件变小时视为发生了轮转并从头读取。单次读取量不超过 ZBX_LOG_READ_LIMIT，
+    超出时只读取最后的部分，因此对于数 GB 的日志开销也是固定的。
+    新增的行通过一个预编译的正则分类，分类见 patterns。
+    """
+    # (分类, 级别, 正则)，同时适用于 agentd 与 agent2 的日志
+    patterns = [
+        ("cannot_bind", "error", r"cannot (?:bind|listen) |listen tcp [^ ]*: bind: |zbx_tcp_listen\(\) fatal error"),
+        ("active_check_failure", "error", r"active check (?:configuration update|data upload) .* started to fail|"
+            r"cannot (?:receive|send) (?:data|list of active checks)|no active checks on server"),
+        ("startup_failure", "error", r"cannot (?:initialize|open log file|create PID file)|failed to (?:start|initialize)|"
+            r"[Zz]abbix [Aa]gent.* stopped\. Zabbix.* \(revision"),
+        ("connection_rejected", "warning", r"failed to accept an incoming connection|connection from \"[^\"]*\" rejected"),
+        ("slow_item", "warning", r"[Tt]imeout while (?:executing|answering)|timed out|[Tt]imeout occurred"),
+        ("not_supported", "warning", r"became not supported"),
+    ]
+    levels = dict((name, level) for name, level, _ in patterns)
+    _pattern_re = None
+
+    @classmethod
+    def pattern_re(cls):
+        """所有分类合并后的正则，首次使用时编译。
+        """
+        if cls._pattern_re is None:
+            cls._pattern_re = re.compile("|".join("(?P<{!s}>{!s})".format(name, regex) for name, _, regex in cls.patterns))
+        return cls._pattern_re
+
+    def __init__(self, state_path=None):
+        # 目录不可信时 state_path 为 None，偏移只保存在内存中
+        self.state_path = secure_state_path("log_state.json", state_path or ZBX_LOG_STATE_PATH)
+        self._data = None
+        self._dirty = False
+        self._save_time = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = read_state_file(self.state_path)
+        return self._data
+
+    def _update(self, log_path, record):
+        data = self._load()
+        if data.get(log_path) != record:
+            if record is None:
+                data.pop(log_path, None)
+            else:
+                data[log_path] = record
+            self._dirty = True
+
+    def save(self, min_interval=0):
+        """将偏移写回磁盘，写入失败不影响主流程。
+        偏移未变化，或者距上次写入不足 min_interval 秒时跳过。
+        """
+        import json
+        import tempfile
+        if not self._dirty or not self.state_path:
+            return
+        if self._save_time is not None and _monotonic() - self._save_time < min_interval:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".zbx_runctl.", dir=os.path.dirname(self.state_path))
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(self._load()))
+            _replace_file(tmp_path, self.state_path)
+            self._dirty = False
+            self._save_time = _monotonic()
+        except (IOError, OSError) as e:
+            logging.debug("Cannot save the log state:[{!s}]: {!s}.".format(self.state_path, e))
+
+    def mark(self, log_path):
+        """将偏移设置为日志当前的末尾，之后的 inspect 只分析此后写入的内容。
+        """
+        try:
+            st = os.stat(log_path)
+        except OSError:
+            self._update(log_path, None)
+            return
+        self._update(log_path, {"inode": st.st_ino, "offset": st.st_size})
+
+    def inspect(self, log_path, limit=None):
+        """分析日志中自上次记录的偏移之后新增的内容，并更新偏移。
+        没有记录时只分析最后 limit 字节。
+
+        Returns:
+            <dict>: 包含 path、rotated、truncated、bytes、lines，以及 counts（分类 -> 次数）
+                与 samples（分类 -> 最近 ZBX_LOG_SAMPLE_COUNT 行）。
+        """
+        limit = ZBX_LOG_READ_LIMIT if limit is None else limit
+        res = {"path": log_path, "rotated": False, "truncated": False, "bytes": 0, "lines": 0, "counts": {}, "samples": {}}
+        begin = _monotonic()
+        try:
+            st = os.stat(log_path)
+        except OSError:
+            return res
+        state = self._load().get(log_path)
+        offset = max(st.st_size - limit, 0)
+        if state:
+            if state["inode"] != st.st_ino or state["offset"] > st.st_size:
+                res["rotated"] = True
+                offset = 0
+            else:
+                offset = state["offset"]
+        if st.st_size - offset > limit:
+            offset = st.st_size - limit
+            res["truncated"] = True
+        with open(log_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(st.st_size - offset)
+        # 从中间开始读取时丢弃不完整的首行，末尾不完整的行留到下次读取
+        if offset and (res["truncated"] or not state):
+            data = data[data.find(b"\n") + 1:] if b"\n" in data else b""
+        end = data.rfind(b"\n") + 1
+        self._update(log_path, {"inode": st.st_ino, "offset": st.st_size - (len(data) - end)})
+        res["bytes"] = end
+        get_metrics().record_io("read", log_path, end, _monotonic() - begin)
+        pattern_re = self.pattern_re()
+        for line in data[:end].decode("utf-8", "replace").split("\n")[:-1]:
+            res["lines"] += 1
+            tmp = pattern_re.search(line)
+            if not tmp:
+                continue
+            name = tmp.lastgroup
+            res["counts"][name] = res["counts"].get(name, 0) + 1
+            sample_lst = res["samples"].setdefault(name, [])
+            sample_lst.append(line.strip())
+            if len(sample_lst) > ZBX_LOG_SAMPLE_COUNT:
+                sample_lst.pop(0)
+        return res
+
+
+def agent_log_path(config_path, effective=None):
+    """从有效配置中获取 agent 的日志文件，日志未输出至文件时返回 None。
+    effective 为调用方已缓存的 EffectiveConfig，为空时重新获取。
+    """
+    effective = effective or resolve_effective_config(config_path)
+    if (effective.get("LogType") or "file") != "file":
+        return None
+    return effective.get("LogFile") or None
+
+def format_log_summary(summary):
+    """将 AgentLogInspector.inspect 的结果格式化为文本，error 类别附带最近的日志行。
+    """
+    if summary is None:
+        return "agent log: not available"
+    count_str = ", ".join("{!s}={!s}".format(k, v) for k, v in sorted(summary["counts"].items())) or "no known issues"
+    out_str = "agent log {!s}: {!s} new lines{!s}{!s}, {!s}".format(summary["path"], summary["lines"],
+        " (rotated)" if summary["rotated"] else "", " (truncated)" if summary["truncated"] else "", count_str)
+    for name in sorted(summary["samples"]):
+        if AgentLogInspector.levels[name] == "error":
+            out_str += "".join("\n    [{!s}] {!s}".format(name, line) for line in summary["samples"][name])
+    return out_str
+
+def inspect_agent_log(config_path, inspector=None, effective=None):
+    """分析 agent 日志的新增内容，任何异常都不会向外抛出。
+
+    Args:
+        config_path: 主配置文件路径，从中获取 LogFile。
+        inspector: AgentLogInspector，为空时新建并在分析后保存偏移。
+        effective: 见 agent_log_path。
+    Returns:
+        <dict>: 见 AgentLogInspector.inspect，无法分析时为 None。
+    """
+    own_inspector = inspector is None
+    try:
+        log_path = agent_log_path(config_path, effective)
+        if not log_path:
+            return None
+        inspector = inspector or AgentLogInspector()
+        res = inspector.inspect(log_path)
+        if own_inspector:
+            inspector.save()
+        return res
+    except Exception as e:
+        logging.debug("Cannot inspect the agent log of {!s}: {!s}.".format(config_path, e))
+        return None
+
+def get_zbx_agent_config_path(os_system, agent_type):
+    """
+    """
+    if os_system == "windows":
+        if agent_type in (1, 2):
+            return ZBX_WIN_AGENTD_CONF_PATH
+    if os_system == "linux":
+        if agent_type == 1:
+            return ZBX_LNX_AGENTD_CONF_PATH
+        elif agent_type == 2:
+            return ZBX_LNX_AGENT2_CONF_PATH
+
+class AgentInstance(object):
+    """主机上的一个 zabbix-agent 实例。
+
+    Attributes:
+        service_name: 服务名称，如 zabbix-agent、zabbix-agent2、zabbix-agent@10051。
+        agent_type: 1 为 agentd，2 为 agent2。
+        config_path: 该实例使用的配置文件路径。
+    """
+    def __init__(self, service_name, agent_type, config_path):
+        self.service_name = service_name
+        self.agent_type = agent_type
+        self.config_path = config_path
+
+    def __repr__(self):
+        return "AgentInstance({!r}, {!r}, {!r})".format(self.service_name, self.agent_type, self.config_path)
+
+
+def _instance_agent_type(text):
+    return 2 if "agent2" in text else 1
+
+def _expand_unit_env(text, env):
+    return re.sub(r"\$\{?(\w+)\}?", lambda m: env.get(m.group(1), m.group(0)), text)
+
+def lnx_discover_systemd_instances():
+    """通过 systemctl 枚举所有 zabbix-agent 单元，并从 ExecStart 的 -c 参数获取配置文件路径。
+    """
+    unit_lst = []
+    for command_lst in (
+        ["systemctl", "list-unit-files", "--no-legend", "zabbix-agent*"],
+        ["systemctl", "list-units", "--all", "--plain", "--no-legend", "zabbix-agent*"],
+    ):
+        _, output = lnx_command_output(command_lst)
+        for line in output.splitlines():
+            fields = line.split()
+            # 模板单元 zabbix-agent@.service 本身不是实例
+            if not fields or not fields[0].endswith(".service") or fields[0].endswith("@.service"):
+                continue
+            if fields[0] not in unit_lst:
+                unit_lst.append(fields[0])
+    if not unit_lst:
+        return []
+    _, output = lnx_command_output(["systemctl", "show", "-p", "Id", "-p", "ExecStart", "-p", "Environment"] + unit_lst)
+    res = []
+    for block in re.split(r"\n\s*\n", output.strip()):
+        props = {}
+        for line in block.splitlines():
+            if "=" in line:
+                k, v = line.split("=", 1)
+                props[k] = v
+        if not props.get("Id"):
+            continue
+        env = dict(i.split("=", 1) for i in props.get("Environment", "").split() if "=" in i)
+        exec_start = _expand_unit_env(props.get("ExecStart", ""), env)
+        agent_type = _instance_agent_type(props["Id"] + exec_start)
+        tmp = re.search(r"(?:-c|--config)\s+(\S+)", exec_start)
+        config_path = tmp.group(1) if tmp else get_zbx_agent_config_path("linux", agent_type)
+        res.append(AgentInstance(props["Id"][:-len(".service")], agent_type, config_path))
+    return res
+
+def lnx_discover_sysvinit_instances():
+    """通过 /etc/init.d 下的启动脚本枚举 zabbix-agent 实例，配置文件见 sysvinit_config_path。
+    无法确定配置文件的非默认实例会被跳过，不会套用默认实例的配置文件。
+    """
+    import glob
+    res = []
+    for script in sorted(glob.glob("/etc/init.d/zabbix-agent*")):
+        service_name = os.path.basename(script)
+        config_path = sysvinit_config_path(service_name)
+        if not config_path:
+            logging.warning("Skip the agent instance {!s}: cannot find its config in {!s}.".format(service_name, script))
+            continue
+        res.append(AgentInstance(service_name, _instance_agent_type(service_name), config_path))
+    return res
+
+def discover_agent_instances():
+    """枚举当前主机上所有的 zabbix-agent 实例。
+    Windows 不支持多实例，只返回 ZBX_WIN_AGENTD_SERVICE_NAME 这一个默认实例。
+
+    Returns:
+        <list>: AgentInstance 列表，未发现时为空列表。
+    """
+    facts = get_host_facts()
+    if facts.os_system == "windows":
+        if win_service_status(ZBX_WIN_AGENTD_SERVICE_NAME) == -1:
+            return []
+        return [AgentInstance(ZBX_WIN_AGENTD_SERVICE_NAME, 1, ZBX_WIN_AGENTD_CONF_PATH)]
+    if facts.init_system == "systemd":
+        return lnx_discover_systemd_instances()
+    return lnx_discover_sysvinit_instances()
+
+@traced("instances.discover")
+def select_agent_instances(selector):
+    """按选择条件过滤实例。
+
+    Args:
+        selector: "all" 表示全部实例，否则为逗号分隔的服务名称。
+    Returns:
+        <list>: 选中的 AgentInstance 列表。
+    """
+    instance_lst = discover_agent_instances()
+    if selector.strip().lower() == "all":
+        return instance_lst
+    name_lst = [i.strip() for i in selector.split(",") if i.strip()]
+    res = [i for i in instance_lst if i.service_name in name_lst]
+    missing = set(name_lst) - set(i.service_name for i in res)
+    if missing:
+        raise Exception("the agent instances {!s} are not found".format(", ".join(sorted(missing))))
+    return res
+
+def instance_execute(mode, instance, edit_dict=None, snapshot_dict=None, lock=None):
+    """对单个实例执行 start/stop/restart/status/edit，异常不会向外抛出。
+    snapshot_dict 与 lock 见 zbx_config_transaction。
+
+    Returns:
+        <dict>: 包含 service、config、ok、state、changed、elapsed、error。
+    """
+    res = {"service": instance.service_name, "config": instance.config_path, "ok": False,
+        "state": "", "changed": None, "elapsed": 0.0, "error": ""}
+    begin = _monotonic()
+    try:
+        if mode == "status":
+            res["state"] = get_service_backend().state(instance.service_name)
+            res["ok"] = res["state"] == "RUNNING"
+        elif mode in ("start", "stop", "restart"):
+            transition = service_transition(mode, instance.service_name)
+            res["state"], res["ok"] = transition["state"], transition["ready"]
+        elif mode == "edit":
+            report = zbx_config_transaction(instance.config_path, instance.service_name, edit_dict,
+                snapshot_dict=snapshot_dict, lock=lock)
+            res["changed"], res["ok"] = report["changed"], report["ok"]
+            res["state"] = get_service_backend().state(instance.service_name)
+            if not report["ok"]:
+                res["error"] = format_transaction_report(report)
+        else:
+            raise Exception("not supported mode {!s} for agent instances".format(mode))
+    except Exception as e:
+        res["error"] = str(e) or e.__class__.__name__
+    res["elapsed"] = _monotonic() - begin
+    return res
+
+@traced("instances.run")
+def run_agent_instances(mode, instance_lst, edit_dict=None, workers=None):
+    """使用线程池并发地对多个实例执行操作。
+    edit 时多个实例可能通过 Include 共享同一个文件：先在任何修改之前为所有实例获取快照，
+    修改与回滚逐个进行，之后有效配置与快照不同的实例都会重启，即使共享的修改已由其他实例写入。
+
+    Returns:
+        <list>: 与 instance_lst 顺序一致的 instance_execute 结果列表。
+    """
+    import threading
+    from multiprocessing.pool import ThreadPool
+    if not instance_lst:
+        return []
+    lock = threading.Lock()
+    snapshot_lst = [None] * len(instance_lst)
+    if mode == "edit":
+        for n, instance in enumerate(instance_lst):
+            try:
+                snapshot_lst[n] = config_snapshot(instance.config_path)
+            except (IOError, OSError) as e:
+                # 由事务的 snapshot 阶段重新获取并报告错误
+                logging.debug("Cannot snapshot the config of {!s}: {!s}.".format(instance.service_name, e))
+    pool = ThreadPool(min(workers or ZBX_INSTANCE_WORKERS, len(instance_lst)))
+    try:
+        return pool.map(lambda n: instance_execute(mode, instance_lst[n], edit_dict, snapshot_lst[n], lock),
+            range(len(instance_lst)))
+    finally:
+        pool.close()
+        pool.join()
+
+def format_instance_table(result_lst):
+    """将实例执行结果格式化为文本表格。
+    """
+    header = ("SERVICE", "CONFIG", "OK", "STATE", "CHANGED", "ELAPSED", "ERROR")
+    row_lst = [header]
+    for i in result_lst:
+        changed = "-" if i["changed"] is None else ("yes" if i["changed"] else "unchanged")
+        row_lst.append((i["service"], i["config"], "yes" if i["ok"] else "no", i["state"], changed,
+            "{:.2f}s".format(i["elapsed"]), i["error"]))
+    width_lst = [max(len(str(row[n])) for row in row_lst) for n in range(len(header))]
+    return "\n".join("  ".join(str(v).ljust(w) for v, w in zip(row, width_lst)).rstrip() for row in row_lst)
+
+@traced("config.check")
+def zbx_config_check(config_path, flavour=None):
+    """检查 zabbix-agent 配置信息，Include 引入的配置会一并展开，并标注来源文件与行号，
+    同时按 agent 类型对配置做语义校验，诊断信息以 path:lineno 的形式输出。
+
+    Args:
+        config_path: 配置文件路径。
+        flavour: 1 为 agentd，2 为 agent2，为空时根据文件名判断。
+    Returns:
+        <dict>: 包含 config、errors、warnings 数量，以及 diagnostics 列表。
+    """
+    if not os.path.isfile(config_path):
+        logging.error("The config:[{!s}] is not a file not not exists.".format(config_path))
+        raise Exception()
+    if not os.access(config_path, os.W_OK):
+        logging.error("The config:[{!s}] is not allow to write.".format(config_path))
+        raise Exception()
+    effective = resolve_effective_config(config_path)
+    validator = ConfigValidator(flavour or config_flavour(config_path))
+    conf_lst = []
+    for path, lineno, key, value in effective.entries:
+        validator.feed(path, lineno, key, value)
+        if path == config_path:
+            conf_lst.append("{!s}={!s}".format(key, value))
+        else:
+            conf_lst.append("{!s}={!s}    # {!s}:{!s}".format(key, value, path, lineno))
+    validator.finish()
+    out_str = "Check the conf:[{!s}] is:\n".format(config_path)
+    out_str += "\n".join(conf_lst)
+    logging.info(out_str)
+    for i in validator.diagnostics:
+        (logging.error if i.level == "error" else logging.warning)(format_config_diagnostic(i))
+    return {"config": config_path, "errors": len(validator.errors), "warnings": len(validator.warnings),
+        "diagnostics": [i._asdict() for i in validator.diagnostics]}
+
+class AgentConfig(object):
+    """zabbix-agent 配置文件的解析结果，保留注释与行顺序。
+    一次遍历建立 key -> 行号 以及 UserParameter 的 item key -> 行号 的索引，
+    之后的修改、删除、追加均为 O(1)，删除的行以 None 占位以保持行号不变。
+
+    Attributes:
+        lines: 原始行列表（包含换行符），已删除的行为 None。
+        index: 配置项 -> 行号列表，不包含 UserParameter。
+        userparameters: UserParameter 的 item key -> 行号列表。
+    """
+    _line_re = re.compile(r"^([A-Za-z0-9_.]+) *= *(.*?)\s*$")
+
+    def __init__(self, lines=None):
+        self.lines = []
+        self.index = {}
+        self.userparameters = {}
+        for line in lines or []:
+            self._append_line(line)
+
+    @classmethod
+    def from_file(cls, config_path):
+        # 仅按 \n 切分并保留换行符，与逐行读取文件的结果一致
+        part_lst = read_config_text(config_path).split("\n")
+        return cls([i + "\n" for i in part_lst[:-1]] + [i for i in part_lst[-1:] if i])
+
+    @staticmethod
+    def userparameter_key(value):
+        """UserParameter 的值形如 key,command，返回其中的 item key。
+        """
+        return value.split(",", 1)[0].strip()
+
+    def _append_line(self, line):
+        lineno = len(self.lines)
+        self.lines.append(line)
+        tmp = self._line_re.match(line)
+        if not tmp:
+            return
+        key, value = tmp.group(1), tmp.group(2)
+        if key == "UserParameter":
+            self.userparameters.setdefault(self.userparameter_key(value), []).append(lineno)
+        else:
+            self.index.setdefault(key, []).append(lineno)
+
+    def _value(self, lineno):
+        return self._line_re.match(self.lines[lineno]).group(2)
+
+    def _replace(self, lineno, text):
+        line = self.lines[lineno]
+        self.lines[lineno] = text + line[len(line.rstrip("\r\n")):]
+
+    def _newline(self):
+        # 若文件末行没有换行符，追加前需要补上
+        if self.lines and self.lines[-1] is not None and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += os.linesep
+        return os.linesep
+
+    def get(self, key):
+        """获取配置项的值，存在多个时以最后一个为准，不存在时返回 None。
+        """
+        lineno_lst = self.index.get(key)
+        if not lineno_lst:
+            return None
+        return self._value(lineno_lst[-1])
+
+    def set(self, key, value):
+        """修改配置项，不存在时追加至尾部。
+
+        Returns:
+            <str>: 修改前的值，新增时为 None。
+        """
+        old = self.get(key)
+        lineno_lst = self.index.get(key)
+        if lineno_lst:
+            for lineno in lineno_lst:
+                self._replace(lineno, "{!s}={!s}".format(key, value))
+        else:
+            self.index[key] = [len(self.lines)]
+            self.lines.append("{!s}={!s}{!s}".format(key, value, self._newline()))
+        return old
+
+    def delete(self, key):
+        """删除配置项。
+
+        Returns:
+            <str>: 删除前的值，不存在时为 None。
+        """
+        old = self.get(key)
+        for lineno in self.index.pop(key, []):
+            self.lines[lineno] = None
+        return old
+
+    def get_userparameter(self, item_key):
+        """获取 item key 对应的完整 UserParameter 值（key,command），不存在时返回 None。
+        """
+        lineno_lst = self.userparameters.get(item_key)
+        if not lineno_lst:
+            return None
+        return self._value(lineno_lst[-1])
+
+    def set_userparameter(self, value):
+        """按 item key 修改或追加 UserParameter。
+
+        Args:
+            value: 形如 key,command 的 UserParameter 值。
+        Returns:
+            <str>: 修改前的值，新增时为 None。
+        """
+        item_key = self.userparameter_key(value)
+        old = self.get_userparameter(item_key)
+        lineno_lst = self.userparameters.get(item_key)
+        if lineno_lst:
+            for lineno in lineno_lst:
+                self._replace(lineno, "UserParameter={!s}".format(value))
+        else:
+            self.userparameters[item_key] = [len(self.lines)]
+            self.lines.append("UserParameter={!s}{!s}".format(value, self._newline()))
+        return old
+
+    def delete_userparameter(self, item_key):
+        """按 item key 删除 UserParameter。
+
+        Returns:
+            <str>: 删除前的值，不存在时为 None。
+        """
+        old = self.get_userparameter(item_key)
+        for lineno in self.userparameters.pop(item_key, []):
+            self.lines[lineno] = None
+        return old
+
+    def render(self):
+        return "".join(line for line in self.lines if line is not None)
+
+    def entries(self):
+        """按 render 之后的行号遍历有效配置项。
+
+        Returns:
+            <generator>: (lineno, key, value)，lineno 从 1 开始。
+        """
+        lineno = 0
+        for line in self.lines:
+            if line is None:
+                continue
+            lineno += 1
+            tmp = self._line_re.match(line)
+            if tmp:
+                yield lineno, tmp.group(1), tmp.group(2)
+
+    def write(self, config_path):
+        atomic_write_config(config_path, self.render())
+
+def parse_config_entries(config_path):
+    """一次遍历解析配置文件中的有效配置项，不展开 Include。
+
+    Returns:
+        <list>: [lineno, key, value] 列表，lineno 从 1 开始。
+    """
+    res = []
+    for lineno, line in enumerate(read_config_text(config_path).split("\n"), 1):
+        tmp = AgentConfig._line_re.match(line)
+        if tmp:
+            res.append([lineno, tmp.group(1), tmp.group(2)])
+    return res
+
+
+class ConfigParseCache(object):
+    """parse_config_entries 结果的磁盘缓存。
+    以 (path, inode, size, mtime) 作为失效依据，只有发生变化的文件才会被重新解析。
+    """
+    def __init__(self, cache_path=None):
+        # 目录不可信时 cache_path 为 None，只在内存中缓存
+        self.cache_path = secure_state_path("parse_cache.json", cache_path or ZBX_CONF_PARSE_CACHE_PATH)
+        self._data = None
+        self._dirty = False
+
+    def _load(self):
+        if self._data is None:
+            self._data = read_state_file(self.cache_path)
+        return self._data
+
+    def entries(self, config_path):
+        st = os.stat(config_path)
+        signature = [st.st_ino, st.st_size, st.st_mtime]
+        data = self._load()
+        record = data.get(config_path)
+        if record and record.get("signature") == signature:
+            return record["entries"]
+        entries = parse_config_entries(config_path)
+        data[config_path] = {"signature": signature, "entries": entries}
+        self._dirty = True
+        return entries
+
+    def save(self):
+        """将缓存写回磁盘，写入失败不影响主流程。
+        """
+        import json
+        import tempfile
+        if not self._dirty or not self.cache_path:
+            return
+        try:
+            begin = _monotonic()
+            content = json.dumps(self._data)
+            fd, tmp_path = tempfile.mkstemp(prefix=".zbx_runctl.", dir=os.path.dirname(self.cache_path))
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            _replace_file(tmp_path, self.cache_path)
+            get_metrics().record_io("write", self.cache_path, len(content), _monotonic() - begin)
+            self._dirty = False
+        except (IOError, OSError) as e:
+            logging.debug("Cannot save the parse cache:[{!s}]: {!s}.".format(self.cache_path, e))
+
+
+class EffectiveConfig(object):
+    """展开 Include 之后的有效配置，记录每个配置项的来源文件与行号。
+
+    Attributes:
+        files: 按解析顺序排列的配置文件列表，第一个为主配置文件。
+        entries: 按生效顺序排列的 (path, lineno, key, value) 列表。
+        sources: 配置项 -> (path, lineno, value) 列表，不包含 UserParameter。
+        userparameters: UserParameter 的 item key -> (path, lineno, value) 列表。
+    """
+    def __init__(self):
+        self.files = []
+        self.entries = []
+        self.sources = {}
+        self.userparameters = {}
+
+    def add(self, path, lineno, key, value):
+        self.entries.append((path, lineno, key, value))
+        if key == "UserParameter":
+            self.userparameters.setdefault(AgentConfig.userparameter_key(value), []).append((path, lineno, value))
+        else:
+            self.sources.setdefault(key, []).append((path, lineno, value))
+
+    def get(self, key):
+        """获取配置项最终生效的值，不存在时返回 None。
+        """
+        if not self.sources.get(key):
+            return None
+        return self.sources[key][-1][2]
+
+    @staticmethod
+    def _unique_paths(source_lst):
+        res = []
+        for path, _, _ in source_lst:
+            if path not in res:
+                res.append(path)
+        return res
+
+    def files_of(self, key):
+        """返回定义了该配置项的文件列表。
+        """
+        return self._unique_paths(self.sources.get(key, []))
+
+    def userparameter_files(self, item_key):
+        """返回定义了该 item key 的 UserParameter 的文件列表。
+        """
+        return self._unique_paths(self.userparameters.get(item_key, []))
+
+
+def expand_include(value, base_dir):
+    """按 zabbix-agent 的规则展开 Include 的值：单个文件、目录下所有文件，或文件名通配。
+    相对路径以引入它的配置文件所在目录为基准。
+
+    Returns:
+        <list>: 排序后的文件路径列表。
+    """
+    import glob
+    path = value if os.path.isabs(value) else os.path.join(base_dir, value)
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, i) for i in os.listdir(path) if os.path.isfile(os.path.join(path, i)))
+    if glob.has_magic(path):
+        return sorted(i for i in glob.glob(path) if os.path.isfile(i))
+    if not os.path.isfile(path):
+        logging.warning("The include:[{!s}] is not a file not not exists.".format(path))
+        return []
+    return [path]
+
+@traced("config.resolve")
+def resolve_effective_config(config_path, cache=None):
+    """解析主配置文件并递归展开 Include，得到有效配置。
+
+    Args:
+        config_path: 主配置文件路径。
+        cache: ConfigParseCache，为空时使用默认缓存，并在解析结束后写回磁盘。
+    Returns:
+        <EffectiveConfig>
+    """
+    own_cache = cache is None
+    if own_cache:
+        cache = ConfigParseCache()
+    effective = EffectiveConfig()
+    visited = set()
+
+    def walk(path):
+        real_path = os.path.realpath(path)
+        if real_path in visited:
+            logging.warning("The include:[{!s}] is included more than once, skip it.".format(path))
+            return
+        visited.add(real_path)
+        effective.files.append(path)
+        for lineno, key, value in cache.entries(path):
+            effective.add(path, lineno, key, value)
+            if key == "Include":
+                for include_path in expand_include(value, os.path.dirname(path)):
+                    walk(include_path)
+
+    walk(config_path)
+    if own_cache:
+        cache.save()
+    return effective
+
+
+# 各类 agent 可识别的配置项，1 为 agentd，2 为 agent2，agent2 另外接受 Plugins.* 配置
+ZBX_AGENT_PARAMS = {
+    1: frozenset([
+        "Alias", "AllowKey", "AllowRoot", "BufferSend", "BufferSize", "DebugLevel", "DenyKey",
+        "EnableRemoteCommands", "HeartbeatFrequency", "HostInterface", "HostInterfaceItem",
+        "HostMetadata", "HostMetadataItem", "Hostname", "HostnameItem", "Include", "ListenBacklog",
+        "ListenIP", "ListenPort", "LoadModule", "LoadModulePath", "LogFile", "LogFileSize",
+        "LogRemoteCommands", "LogType", "MaxLinesPerSecond", "PerfCounter", "PerfCounterEn", "PidFile",
+        "RefreshActiveChecks", "Server", "ServerActive", "SourceIP", "StartAgents", "Timeout",
+        "TLSAccept", "TLSCAFile", "TLSCertFile", "TLSCipherAll", "TLSCipherAll13", "TLSCipherCert",
+        "TLSCipherCert13", "TLSCipherPSK", "TLSCipherPSK13", "TLSConnect", "TLSCRLFile", "TLSKeyFile",
+        "TLSPSKFile", "TLSPSKIdentity", "TLSServerCertIssuer", "TLSServerCertSubject",
+        "UnsafeUserParameters", "User", "UserParameter", "UserParameterDir",
+    ]),
+    2: frozenset([
+        "Alias", "AllowKey", "BufferSend", "BufferSize", "ControlSocket", "DebugLevel", "DenyKey",
+        "EnablePersistentBuffer", "ForceActiveChecksOnStart", "HeartbeatFrequency", "HostInterface",
+        "HostInterfaceItem", "HostMetadata", "HostMetadataItem", "Hostname", "HostnameItem", "Include",
+        "ListenIP", "ListenPort", "LogFile", "LogFileSize", "LogType", "PersistentBufferFile",
+        "PersistentBufferPeriod", "PluginSocket", "PluginTimeout", "RefreshActiveChecks", "Server",
+        "ServerActive", "SourceIP", "StatusPort", "Timeout", "TLSAccept", "TLSCAFile", "TLSCertFile",
+        "TLSConnect", "TLSCRLFile", "TLSKeyFile", "TLSPSKFile", "TLSPSKIdentity", "TLSServerCertIssuer",
+        "TLSServerCertSubject", "UnsafeUserParameters", "UserParameter", "UserParameterDir",
+    ]),
+}
+# 允许出现多次的配置项，其余配置项重复时以最后一个为准
+ZBX_AGENT_MULTI_PARAMS = {
+    1: frozenset(["Alias", "AllowKey", "DenyKey", "Include", "LoadModule", "PerfCounter", "PerfCounterEn", "UserParameter"]),
+    2: frozenset(["Alias", "AllowKey", "DenyKey", "Include", "UserParameter"]),
+}
+# 整数配置项的取值范围
+ZBX_AGENT_PARAM_RANGES = {
+    1: {
+        "AllowRoot": (0, 1), "BufferSend": (1, 3600), "BufferSize": (2, 65535), "DebugLevel": (0, 5),
+        "EnableRemoteCommands": (0, 1), "HeartbeatFrequency": (0, 3600), "ListenPort": (1024, 32767),
+        "LogFileSize": (0, 1024), "LogRemoteCommands": (0, 1), "MaxLinesPerSecond": (1, 1000),
+        "RefreshActiveChecks": (1, 86400), "StartAgents": (0, 100), "Timeout": (1, 30),
+        "UnsafeUserParameters": (0, 1),
+    },
+    2: {
+        "BufferSend": (1, 3600), "BufferSize": (2, 65535), "DebugLevel": (0, 5), "EnablePersistentBuffer": (0, 1),
+        "ForceActiveChecksOnStart": (0, 1), "HeartbeatFrequency": (0, 3600), "ListenPort": (1024, 32767),
+        "LogFileSize": (0, 1024), "PluginTimeout": (1, 30), "RefreshActiveChecks": (1, 86400),
+        "StatusPort": (1024, 32767), "Timeout": (1, 30), "UnsafeUserParameters": (0, 1),
+    },
+}
+
+ConfigDiagnostic = namedtuple("ConfigDiagnostic", ["level", "path", "lineno", "key", "message"])
+
+
+def config_flavour(config_path):
+    """根据配置文件名判断 agent 类型。
+
+    Returns:
+        <int>: 文件名包含 agent2 时为 2，否则为 1。
+    """
+    return 2 if "agent2" in os.path.basename(config_path) else 1
+
+def _valid_ip(address):
+    import socket
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    try:
+        socket.inet_pton(family, address)
+    except (socket.error, ValueError):
+        return False
+    return family == socket.AF_INET6 or address.count(".") == 3
+
+
+class ConfigValidator(object):
+    """zabbix-agent 配置的流式校验器。
+    按生效顺序逐条传入配置项，单条即可判断的规则立即检查，需要全局信息的规则
+    只保留必要的状态并在 finish 时检查，内存占用与配置项数量无关。
+
+    Attributes:
+        flavour: 1 为 agentd，2 为 agent2。
+        diagnostics: ConfigDiagnostic 列表，level 为 error 或 warning。
+    """
+    _hostname_re = re.compile(r"^[A-Za-z0-9_]([A-Za-z0-9_.-]*[A-Za-z0-9_])?$")
+    _item_key_re = re.compile(r"^[A-Za-z0-9_.-]+(\[\*\])?$")
+
+    def __init__(self, flavour=1):
+        self.flavour = flavour
+        self.diagnostics = []
+        self._seen = {}
+        self._userparameters = {}
+        self._last = {}
+        self._main_path = None
+
+    def _add(self, level, path, lineno, key, message):
+        self.diagnostics.append(ConfigDiagnostic(level, path, lineno, key, message))
+
+    @property
+    def errors(self):
+        return [i for i in self.diagnostics if i.level == "error"]
+
+    @property
+    def warnings(self):
+        return [i for i in self.diagnostics if i.level == "warning"]
+
+    def _check_address(self, address, allow_cidr):
+        """校验单个地址，合法时返回空字符串，否则返回原因。
+        """
+        if allow_cidr and "/" in address:
+            address, prefix = address.split("/", 1)
+            if not _valid_ip(address):
+                return "invalid network address {!s}".format(address)
+            if not prefix.isdigit() or int(prefix) > (128 if ":" in address else 32):
+                return "invalid network prefix /{!s}".format(prefix)
+            return ""
+        if ":" in address or re.match(r"^[0-9.]+$", address):
+            return "" if _valid_ip(address) else "invalid ip address {!s}".format(address)
+        return "" if self._hostname_re.match(address) else "invalid hostname {!s}".format(address)
+
+    def _check_server(self, value):
+        for address in value.split(","):
+            address = address.strip()
+            if not address:
+                return "empty address in list"
+            reason = self._check_address(address, True)
+            if reason:
+                return reason
+        return ""
+
+    def _check_server_active(self, value):
+        # 6.0 起以分号分隔同一集群中的多个节点
+        for address in re.split(r"[,;]", value):
+            address = address.strip()
+            if not address:
+                return "empty address in list"
+            port = None
+            if address.startswith("["):
+                tmp = re.match(r"^\[([^\]]+)\](?::(.*))?$", address)
+                if not tmp:
+                    return "invalid address {!s}".format(address)
+                address, port = tmp.group(1), tmp.group(2)
+            elif address.count(":") == 1:
+                address, port = address.split(":")
+            if port is not None and not (port.isdigit() and 1 <= int(port) <= 65535):
+                return "invalid port {!s}".format(port)
+            reason = self._check_address(address, False)
+            if reason:
+                return reason
+        return ""
+
+    def feed(self, path, lineno, key, value):
+        """传入一条配置项并检查单条规则。
+        """
+        if self._main_path is None:
+            self._main_path = path
+        if key not in ZBX_AGENT_PARAMS[self.flavour] and not (self.flavour == 2 and key.startswith("Plugins.")):
+            self._add("warning", path, lineno, key, "unknown parameter for zabbix agent{!s}".format(
+                "2" if self.flavour == 2 else "d"))
+        if key not in ZBX_AGENT_MULTI_PARAMS[self.flavour]:
+            if key in self._seen:
+                self._add("warning", path, lineno, key, "duplicate parameter, overrides the one at {!s}:{!s}".format(
+                    *self._seen[key]))
+            self._seen[key] = (path, lineno)
+            self._last[key] = (path, lineno, value)
+        if key in ZBX_AGENT_PARAM_RANGES[self.flavour]:
+            low, high = ZBX_AGENT_PARAM_RANGES[self.flavour][key]
+            if not re.match(r"^[0-9]+$", value) or not low <= int(value) <= high:
+                self._add("error", path, lineno, key, "value '{!s}' is not an integer in range {!s}-{!s}".format(
+                    value, low, high))
+        if key == "Server" and value:
+            reason = self._check_server(value)
+            if reason:
+                self._add("error", path, lineno, key, "malformed Server list: {!s}".format(reason))
+        elif key == "ServerActive" and value:
+            reason = self._check_server_active(value)
+            if reason:
+                self._add("error", path, lineno, key, "malformed ServerActive list: {!s}".format(reason))
+        elif key == "UserParameter":
+            if "," not in value or not value.split(",", 1)[1].strip():
+                self._add("error", path, lineno, key, "UserParameter must be in the form key,command")
+                return
+            item_key = AgentConfig.userparameter_key(value)
+            if not self._item_key_re.match(item_key):
+                self._add("error", path, lineno, key, "invalid item key '{!s}'".format(item_key))
+            elif item_key in self._userparameters:
+                self._add("error", path, lineno, key, "duplicate UserParameter key '{!s}', first defined at {!s}:{!s}".format(
+                    item_key, *self._userparameters[item_key]))
+            else:
+                self._userparameters[item_key] = (path, lineno)
+
+    def finish(self):
+        """检查需要全局信息的规则。
+
+        Returns:
+            <list>: ConfigDiagnostic 列表。
+        """
+        value_of = lambda key: self._last.get(key, (None, None, ""))[2]
+        if self.flavour == 1 and value_of("StartAgents") != "0" and not value_of("Server"):
+            path, lineno, _ = self._last.get("Server", self._last.get("StartAgents", (self._main_path, 0, "")))
+            self._add("error", path, lineno, "Server", "Server must be defined unless StartAgents=0")
+        if value_of("LogType") in ("", "file") and value_of("LogFile"):
+            path, lineno, log_file = self._last["LogFile"]
+            log_dir = os.path.dirname(log_file) or "."
+            if not os.path.isdir(log_dir):
+                self._add("error", path, lineno, "LogFile", "the directory {!s} does not exist".format(log_dir))
+            elif not os.access(log_dir, os.W_OK | os.X_OK):
+                self._add("error", path, lineno, "LogFile", "the directory {!s} is not writable".format(log_dir))
+        return self.diagnostics
+
+
+def validate_config_entries(entries, flavour=1):
+    """流式校验配置项。
+
+    Args:
+        entries: (path, lineno, key, value) 的可迭代对象。
+        flavour: 1 为 agentd，2 为 agent2。
+    Returns:
+        <ConfigValidator>
+    """
+    validator = ConfigValidator(flavour)
+    for path, lineno, key, value in entries:
+        validator.feed(path, lineno, key, value)
+    validator.finish()
+    return validator
+
+def format_config_diagnostic(diagnostic):
+    return "{!s}:{!s}: {!s}: {!s}: {!s}".format(diagnostic.path, diagnostic.lineno, diagnostic.level,
+        diagnostic.key, diagnostic.message)
+
+def _fingerprint_hash(key, value_lst):
+    import hashlib
+    text = "{!s}={!s}".format(key, "\n".join(value_lst))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def fingerprint_values(entries):
+    """将配置项归一化为 指纹键 -> 值列表：去除首尾空白，忽略 Include 本身（其内容已展开），
+    UserParameter 按 item key 拆分为 UserParameter:<item key>，其余可重复的配置项保留出现顺序，
+    不可重复的配置项以最后一个为准。
+
+    Args:
+        entries: (path, lineno, key, value) 的可迭代对象。
+    Returns:
+        <dict>
+    """
+    multi_set = ZBX_AGENT_MULTI_PARAMS[1] | ZBX_AGENT_MULTI_PARAMS[2]
+    res = {}
+    for _, _, key, value in entries:
+        value = value.strip()
+        if key == "Include":
+            continue
+        if key == "UserParameter":
+            item_key = AgentConfig.userparameter_key(value)
+            res["UserParameter:" + item_key] = ["{!s},{!s}".format(item_key, value.split(",", 1)[-1].strip())]
+        elif key in multi_set:
+            res.setdefault(key, []).append(value)
+        else:
+            res[key] = [value]
+    return res
+
+def config_fingerprint(entries):
+    """计算有效配置的指纹，与配置项的顺序及所在文件无关。
+
+    Args:
+        entries: (path, lineno, key, value) 的可迭代对象，通常为 EffectiveConfig.entries。
+    Returns:
+        <dict>: 包含 hash（整体指纹）与 keys（指纹键 -> 单项指纹）。
+    """
+    import hashlib
+    keys = dict((k, _fingerprint_hash(k, v)) for k, v in fingerprint_values(entries).items())
+    text = "\n".join("{!s}={!s}".format(k, keys[k]) for k in sorted(keys))
+    return {"hash": hashlib.sha256(text.encode("utf-8")).hexdigest(), "keys": keys}
+
+@traced("config.validate")
+def validate_candidate_config(config_path, effective, config_map):
+    """校验修改后的有效配置，存在 error 时抛出异常。
+    未修改的文件沿用 effective 中的解析结果，修改过的文件以 config_map 中内存里的新内容代替。
+
+    Args:
+        config_path: 主配置文件路径。
+        effective: 修改前的 EffectiveConfig。
+        config_map: 文件路径 -> 修改后的 AgentConfig。
+    """
+    def candidate_entries():
+        emitted = set()
+        for path, lineno, key, value in effective.entries:
+            if path not in config_map:
+                yield path, lineno, key, value
+            elif path not in emitted:
+                emitted.add(path)
+                for entry in config_map[path].entries():
+                    yield (path,) + entry
+        for path in config_map:
+            if path not in emitted:
+                for entry in config_map[path].entries():
+                    yield (path,) + entry
+
+    validator = validate_config_entries(candidate_entries(), config_flavour(config_path))
+    for i in validator.diagnostics:
+        (logging.error if i.level == "error" else logging.warning)(format_config_diagnostic(i))
+    if validator.errors:
+        raise Exception("the candidate config has {!s} error(s), the first is {!s}".format(
+            len(validator.errors), format_config_diagnostic(validator.errors[0])))
+
+@traced("config.edit")
+def zbx_config_edit(config_path, config_dict):
+    """修改 zabbix-agent 配置文件的参数，写入前会校验修改后的配置，存在 error 时抛出异常且不写入。
+
+    Args:
+        config_path: 需要修改的 zabbix-agent 的配置文件路径。
+        config_dict: 需要修改的参数内容，UserParameter 为列表，
+            元素以 ",DEL" 结尾时表示删除该 item key。
+
+    Returns:
+        <bool>: 配置是否发生变化，未变化时不会重写配置文件。
+    """
+    if all(config_dict.get(i) in ('', [], None) for i in config_dict):
+        logging.info("No config to edit.")
+        config = AgentConfig.from_file(config_path)
+        for i in config_dict:
+            if config.get(i) is not None:
+                logging.info("Now config: {!s}={!s}.".format(i, config.get(i)))
+        return False
+    if not os.path.isfile(config_path):
+        logging.error("The config:[{!s}] is not a file not not exists.".format(config_path))
+        raise Exception()
+    if not os.access(config_path, os.W_OK):
+        logging.error("The config:[{!s}] is not allow to write.".format(config_path))
+        raise Exception()
+    logging.info("Begin to chagne config.")
+    # 配置项可能定义在 Include 引入的文件中，需要修改其实际所在的文件，
+    # 否则在主配置中新增的同名配置会与之重复或被其覆盖
+    effective = resolve_effective_config(config_path)
+    config_map = {}
+    change_lst = []
+
+    def load(path):
+        if path not in config_map:
+            config_map[path] = AgentConfig.from_file(path)
+        return config_map[path]
+
+    def record(path, old, new):
+        if path != config_path:
+            new = "{!s} (in {!s})".format(new, path)
+        change_lst.append((path, old, new))
+
+    for i in config_dict:
+        if not config_dict[i]:
+            continue
+        if i == "UserParameter":
+            for j in config_dict[i]:
+                j = j.strip()
+                if not j:
+                    continue
+                item_key = AgentConfig.userparameter_key(j)
+                # 如果 UserParameter 是带有 DEL 符号的，则需要删除
+                if j.split(',')[-1].strip() == "DEL":
+                    for path in effective.userparameter_files(item_key):
+                        old = load(path).delete_userparameter(item_key)
+                        if old is not None:
+                            logging.debug("For the userparameter_key:[{!s}], DEL it.".format(item_key))
+                            record(path, "UserParameter={!s}".format(old), "")
+                    continue
+                for path in effective.userparameter_files(item_key) or [config_path]:
+                    config = load(path)
+                    if config.get_userparameter(item_key) == j:
+                        continue
+                    old = config.set_userparameter(j)
+                    record(path, "" if old is None else "UserParameter={!s}".format(old), "UserParameter={!s}".format(j))
+        else:
+            for path in effective.files_of(i) or [config_path]:
+                config = load(path)
+                if config.get(i) == str(config_dict[i]).strip():
+                    continue
+                old = config.set(i, config_dict[i])
+                record(path, "{!s}={!s}".format(i, "" if old is None else old), config_dict[i])
+    if not change_lst:
+        logging.info("All config is already set, no change.")
+        return False
+
+    # 写入与重启之前先校验修改后的配置，存在 error 时不做任何修改
+    validate_candidate_config(config_path, effective, config_map)
+    changed_paths = set(i[0] for i in change_lst)
+    write_config_files(config_path, dict((path, config_map[path].render()) for path in effective.files if path in changed_paths))
+    for _, old, new in change_lst:
+        logging.info("Change {!s} -> {!s}".format(old, new))
+    return True
+
+def config_backup_path(config_path, generation):
+    """返回配置文件第 generation 代备份的路径。
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), ".zbx_runctl_backup",
+        "{!s}.{!s}".format(os.path.basename(config_path), generation))
+
+def config_journal_path(config_path):
+    """返回修改日志的路径，与主配置文件的备份放在同一目录。
+    """
+    return os.path.join(os.path.dirname(config_backup_path(config_path, 1)), os.path.basename(config_path) + ".journal")
+
+def load_config_journal(config_path):
+    """读取修改日志：每次修改写入了哪些文件、新建了哪些文件，最新的修改在前，不存在时为空列表。
+    """
+    import json
+    try:
+        return json.loads(read_config_text(config_journal_path(config_path)))
+    except (IOError, OSError, ValueError):
+        return []
+
+def write_config_files(config_path, content_dict, removed=()):
+    """原子地写入一次修改涉及的所有文件（主配置文件与 Include 引入的文件），并记录修改日志。
+    各文件的备份代数各自轮转，只修改部分文件时代数并不对齐，rollback 需要据修改日志
+    得知每次修改写入了哪些文件，才能恢复同一次修改写入的所有文件。
+
+    Args:
+        config_path: 主配置文件路径，修改日志保存在其备份目录中。
+        content_dict: 文件路径 -> 新的内容。
+        removed: 需要删除的文件，删除前同样轮转备份。
+    """
+    import json
+    import tempfile
+    created = sorted(path for path in content_dict if not os.path.exists(path))
+    for path in sorted(content_dict):
+        atomic_write_config(path, content_dict[path])
+    for path in removed:
+        rotate_config_backups(path)
+        os.remove(path)
+    if ZBX_CONF_BACKUP_COUNT <= 0:
+        return
+    journal = [{"time": time.time(), "files": sorted(set(content_dict) | set(removed)), "created": created}] + load_config_journal(config_path)
+    journal_path = config_journal_path(config_path)
+    if not os.path.isdir(os.path.dirname(journal_path)):
+        os.makedirs(os.path.dirname(journal_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".zbx_runctl.", dir=os.path.dirname(journal_path))
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(journal[:ZBX_CONF_BACKUP_COUNT]))
+    _replace_file(tmp_path, journal_path)
+
+def config_snapshot(config_path, paths=None):
+    """读取有效配置涉及的所有文件的内容，用于回滚。
+
+    Args:
+        config_path: 主配置文件路径。
+        paths: 有效配置之外同样需要快照的文件，不存在时内容记为 None。
+    Returns:
+        <dict>: 文件路径 -> 内容。
+    """
+    res = dict((path, read_config_text(path)) for path in resolve_effective_config(config_path).files)
+    for path in paths or []:
+        if path not in res:
+            res[path] = read_config_text(path) if os.path.exists(path) else None
+    return res
+
+@traced("config.transaction")
+def zbx_config_transaction(config_path, service_name, config_dict, timeout=None, apply=None, paths=None,
+                           snapshot_dict=None, lock=None):
+    """以事务方式修改配置：快照、修改、重启、校验，校验失败时恢复快照并再次重启。
+    校验要求服务处于运行状态且 agent 在配置的端口上接受连接，StartAgents=0 时只要求服务处于运行状态。
+
+    Args:
+        config_path: 主配置文件路径。
+        service_name: agent 的服务名称。
+        config_dict: 见 zbx_config_edit。
+        timeout: 重启与校验的总时限，默认使用 ZBX_EDIT_VERIFY_TIMEOUT。
+        apply: 代替 zbx_config_edit 的修改函数，无参数，返回配置是否发生变化。
+        paths: 有效配置之外同样需要快照的文件，如 sync-userparams 的目标文件，不存在时回滚会将其删除。
+        snapshot_dict: 调用方预先获取的 config_snapshot，多个实例通过 Include 共享文件时，
+            需要在任何实例修改之前统一获取。
+        lock: 修改与回滚文件时持有的锁，多个实例并发修改共享的文件时使用。
+    Returns:
+        <dict>: 包含 changed、ok、rolled_back、failed_phase，以及 phases 中每个阶段的
+            name、ok、elapsed、error，阶段依次为 snapshot、apply、restart、verify，
+            失败时继续 rollback、restart、verify；发生重启时 log 为重启期间的日志分析结果。
+    """
+    import threading
+    timeout = ZBX_EDIT_VERIFY_TIMEOUT if timeout is None else timeout
+    lock = lock or threading.Lock()
+    deadline = [0]
+    report = {"changed": False, "ok": False, "rolled_back": False, "failed_phase": None, "phases": [], "log": None}
+
+    def run_phase(name, func):
+        begin = _monotonic()
+        phase = {"name": name, "ok": False, "elapsed": 0.0, "error": ""}
+        report["phases"].append(phase)
+        try:
+            with get_metrics().span("transaction." + name):
+                res = func()
+            phase["ok"] = True
+            return res
+        except Exception as e:
+            phase["error"] = str(e) or e.__class__.__name__
+            if report["failed_phase"] is None:
+                report["failed_phase"] = name
+            return None
+        finally:
+            phase["elapsed"] = round(_monotonic() - begin, 6)
+
+    def snapshot():
+        return snapshot_dict if snapshot_dict is not None else config_snapshot(config_path, paths)
+
+    def apply_changes():
+        with lock:
+            if (apply or (lambda: zbx_config_edit(config_path, config_dict)))():
+                return True
+            # 共享的文件可能已被其他实例修改，本实例的有效配置与快照不同时同样需要重启
+            return any((read_config_text(path) if os.path.exists(path) else None) != content
+                for path, content in snapshot_dict.items())
+
+    def restart():
+        transition = service_transition("restart", service_name, max(deadline[0] - _monotonic(), 0))
+        if not transition["ready"]:
+            raise Exception("the state of agent is {!s} after restart".format(transition["state"]))
+        return transition
+
+    def verify():
+        ping = wait_agent_listening(config_path, max(deadline[0] - _monotonic(), 0))
+        if ping["passive"] and not ping["listening"]:
+            raise Exception("the agent is not listening on {!s}".format(ping["endpoint"]))
+        return ping
+
+    def restart_verify():
+        deadline[0] = _monotonic() + timeout
+        return run_phase("restart", restart) is not None and run_phase("verify", verify) is not None
+
+    def restore():
+        with lock:
+            restore_files()
+
+    def restore_files():
+        for path, content in snapshot_dict.items():
+            if content is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            elif read_config_text(path) != content:
+                # 回滚不轮转备份，否则失败的修改会占据第 1 代，rollback_generation=1 不再指向修改前的配置
+                atomic_write_config(path, content, backup_count=0)
+
+    snapshot_dict = run_phase("snapshot", snapshot)
+    if snapshot_dict is None:
+        return report
+    log_inspector = AgentLogInspector()
+    log_path = agent_log_path(config_path)
+    if log_path:
+        log_inspector.mark(log_path)
+    report["changed"] = run_phase("apply", apply_changes)
+    if report["failed_phase"]:
+        # 多个文件时可能只写入了一部分，恢复快照即可，agent 尚未重启
+        run_phase("rollback", restore)
+        report["rolled_back"] = report["phases"][-1]["ok"]
+        return report
+    if not report["changed"]:
+        report["ok"] = True
+        return report
+    if restart_verify():
+        report["ok"] = True
+    else:
+        logging.error("the edit failed on phase {!s}, rollback the config".format(report["failed_phase"]))
+        run_phase("rollback", restore)
+        report["rolled_back"] = report["phases"][-1]["ok"]
+        if report["rolled_back"]:
+            # 回滚后的重启与校验同样记录为 restart、verify 阶段
+            restart_verify()
+    # 分析重启期间 agent 新写入的日志，LogFile 可能已被修改，因此重新获取
+    report["log"] = inspect_agent_log(config_path, log_inspector)
+    log_inspector.save()
+    return report
+
+def format_transaction_report(report):
+    """将 zbx_config_transaction 的结果格式化为一行文本。
+    """
+    phase_str = ", ".join("{!s}={!s} {:.2f}s".format(i["name"], "ok" if i["ok"] else "FAILED", i["elapsed"]) for i in report["phases"])
+    if report["ok"]:
+        return "result: {!s} ({!s})".format("changed" if report["changed"] else "unchanged", phase_str)
+    return "result: failed on {!s}, rolled back: {!s} ({!s})".format(report["failed_phase"], report["rolled_back"], phase_str)
+
+def rotate_config_backups(config_path, backup_count=None):
+    """将当前配置文件轮转为编号备份，第 1 代为最新。
+    当前文件以硬链接方式保留为 .1，不复制内容，随后的原子替换不会影响它。
+
+    Args:
+        config_path: 配置文件路径。
+        backup_count: 保留的备份数量，默认使用 ZBX_CONF_BACKUP_COUNT。
     """
+    import shutil
+    if backup_count is None:
+        backup_count = ZBX_CONF_BACKUP_COUNT
+    if backup_count <= 0 or not os.path.isfile(config_path):
+        return
+    backup_dir = os.path.dirname(config_backup_path(config_path, 1))
+    if not os.path.isdir(backup_dir):
+        os.makedirs(backup_dir)
+    for i in range(backup_count - 1, 0, -1):
+        src = config_backup_path(config_path, i)
+        if os.path.exists(src):
+            _replace_file(src, config_backup_path(config_path, i + 1))
+    dst = config_backup_path(config_path, 1)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(config_path, dst)
+    except (AttributeError, OSError):
+        shutil.copy2(config_path, dst)
+
+def _replace_file(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+        return
+    # Python 2 在 Windows 下 rename 无法覆盖已存在的文件
+    if os.name == "nt" and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def atomic_write_config(config_path, content, backup_count=None):
+    """原子地写入配置文件：先写入同目录的临时文件并 fsync，再 rename 覆盖，
+    保留原文件的权限与属主，并在覆盖前轮转历史备份。
+
+    Args:
+        config_path: 配置文件路径。
+        content: 新的配置文件内容。
+        backup_count: 保留的备份数量，默认使用 ZBX_CONF_BACKUP_COUNT。
+    """
+    import tempfile
+    begin = _monotonic()
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(config_path) + ".", dir=config_dir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(config_path):
+            st = os.stat(config_path)
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            if hasattr(os, "chown"):
+                try:
+                    os.chown(tmp_path, st.st_uid, st.st_gid)
+                except OSError as e:
+                    logging.warning("Cannot keep the owner of config:[{!s}]: {!s}.".format(config_path, e))
+        else:
+            # mkstemp 创建的文件权限为 0600，新建的配置文件需要对 agent 用户可读
+            os.chmod(tmp_path, 0o644)
+        rotate_config_backups(config_path, backup_count)
+        _replace_file(tmp_path, config_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if os.name != "nt":
+        dir_fd = os.open(config_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    get_metrics().record_io("write", config_path, len(content), _monotonic() - begin)
+
+@traced("config.rollback")
+def zbx_config_rollback(config_path, generation=1):
+    """撤销最近 generation 次修改，包括写入 Include 引入的文件的部分，当前配置会作为新的 .1 备份保留。
+    按修改日志统计每个文件在这些修改中产生备份的写入次数 k，将其恢复为第 k 代备份；
+    文件是由其中最早的修改新建的则将其删除。没有修改日志的早期修改视为只写入了主配置文件。
+
+    Args:
+        config_path: 主配置文件路径。
+        generation: 撤销的修改次数，1 为恢复到最近一次修改前的配置。
+    Returns:
+        <bool>: 是否有文件被恢复。
+    """
+    journal = load_config_journal(config_path)
+    if generation > len(journal) >= ZBX_CONF_BACKUP_COUNT:
+        raise Exception("only the last {!s} edits can be rolled back".format(len(journal)))
+    count_dict, created = {}, set()
+    for n in range(generation):
+        entry = journal[n] if n < len(journal) else {"files": [config_path], "created": []}
+        for path in entry["files"]:
+            count_dict.setdefault(path, 0)
+            # 由新到旧遍历，最终以最早的一次写入为准；新建文件的写入不产生备份，不计入代数
+            if path in entry.get("created", []):
+                created.add(path)
+            else:
+                count_dict[path] += 1
+                created.discard(path)
+    content_dict, removed = {}, []
+    for path, k in sorted(count_dict.items()):
+        if path in created:
+            # 最早的一次写入新建了该文件，恢复即删除，删除前的内容作为新的 .1 备份保留
+            if os.path.exists(path):
+                removed.append(path)
+            continue
+        backup_path = config_backup_path(path, k)
+        if not os.path.isfile(backup_path):
+            logging.error("The backup:[{!s}] is not a file not not exists.".format(backup_path))
+            raise Exception("no backup generation {!s} for {!s}".format(k, path))
+        content = read_config_text(backup_path)
+        if not os.path.exists(path) or read_config_text(path) != content:
+            content_dict[path] = content
+            logging.info("Rollback config:[{!s}] from [{!s}].".format(path, backup_path))
+    for path in removed:
+        logging.info("Rollback config:[{!s}] by removing it.".format(path))
+    if content_dict or removed:
+        write_config_files(config_path, content_dict, removed)
+    return bool(content_dict or removed)
+
+def load_userparameter_manifest(manifest_path):
+    """读取 UserParameter 清单文件。
+    支持两种格式：
+        - JSON：列表（元素为 key,command）或字典（item key -> command）。
+        - 文本：每行一个 key,command，可带 UserParameter= 前缀，# 开头为注释。
+
+    Args:
+        manifest_path: 清单文件路径。
+    Returns:
+        <OrderedDict>: item key -> 完整的 UserParameter 值（key,command），重复时后者覆盖前者。
+    """
+    import json
+    from collections import OrderedDict
+    content = read_config_text(manifest_path)
+    res = OrderedDict()
+    if content.lstrip()[:1] in ("[", "{"):
+        data = json.loads(content)
+        if isinstance(data, dict):
+            data = ["{!s},{!s}".format(k, v) for k, v in data.items()]
+    else:
+        data = content.splitlines()
+    for i in data:
+        i = i.strip()
+        if not i or i.startswith("#"):
+            continue
+        if i.startswith("UserParameter="):
+            i = i[len("UserParameter="):].strip()
+        if "," not in i:
+            raise Exception("the manifest entry [{!s}] is not like key,command".format(i))
+        res[AgentConfig.userparameter_key(i)] = i
+    return res
+
+@traced("config.sync_userparams")
+def zbx_userparameter_sync(config_path, manifest, target_path=None):
+    """按清单同步 UserParameter：新增缺失的、修改不一致的、删除目标文件中清单外的。
+    已在有效配置的其他文件（如 Include 引入的文件）中定义的 item key 在其所在的文件中修改，
+    不会在目标文件中重复定义；写入前校验修改后的有效配置，存在 error 时抛出异常且不写入。
+
+    Args:
+        config_path: agent 主配置文件路径。
+        manifest: load_userparameter_manifest 的返回值。
+        target_path: 同步的目标文件，默认为主配置文件，可以是 Include 引入的独立配置文件，不存在时将新建。
+    Returns:
+        <dict>: added、changed、removed、unchanged 的数量。
+    """
+    target_path = target_path or config_path
+    effective = resolve_effective_config(config_path)
+    config_map = {}
+    changed_paths = set()
+
+    def load(path):
+        if path not in config_map:
+            config_map[path] = AgentConfig.from_file(path) if os.path.exists(path) else AgentConfig()
+        return config_map[path]
+
+    res = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    target = load(target_path)
+    for item_key in [i for i in target.userparameters if i not in manifest]:
+        target.delete_userparameter(item_key)
+        changed_paths.add(target_path)
+        res["removed"] += 1
+    for item_key, value in manifest.items():
+        path_lst = effective.userparameter_files(item_key) or [target_path]
+        old_lst = [load(path).get_userparameter(item_key) for path in path_lst]
+        if all(old == value for old in old_lst):
+            res["unchanged"] += 1
+            continue
+        for path, old in zip(path_lst, old_lst):
+            if old != value:
+                load(path).set_userparameter(value)
+                changed_paths.add(path)
+        res["added" if all(old is None for old in old_lst) else "changed"] += 1
+    if changed_paths:
+        validate_candidate_config(config_path, effective, dict((path, config_map[path]) for path in changed_paths))
+        write_config_files(config_path, dict((path, config_map[path].render()) for path in changed_paths))
+    logging.info("Sync userparameters to [{!s}]: added {added}, changed {changed}, removed {removed}, unchanged {unchanged}.".format(target_path, **res))
+    return res
+
+@traced("restart")
+def restart_and_verify(service_name, config_path=None):
+    """修改配置后重启 agent 并等待其恢复运行，失败时抛出异常。
+    指定 config_path 时，还需要 agent 在配置的端口上接受连接，有效配置中 StartAgents=0 时只以服务状态为准。
+    """
+    logging.info("begin restart zabbix agent")
+    transition = service_transition("restart", service_name)
+    logging.info("status: {!s}, took {:.2f}s".format(transition["state"], transition["elapsed"]))
+    if not transition["ready"]:
+        raise Exception("the status of agent is bad")
+    if config_path:
+        ping = wait_agent_listening(config_path)
+        if not ping["passive"]:
+            logging.info("agent.ping skipped: {!s}".format(ping["error"]))
+        else:
+            logging.info("agent.ping on {!s}: {!s}, latency {:.4f}s".format(ping["endpoint"], ping["value"] if ping["ok"] else ping["error"], ping["latency"]))
+        if ping["passive"] and not ping["listening"]:
+            raise Exception("the agent is not listening on {!s}".format(ping["endpoint"]))
+        transition["ping"] = ping
+    return transition
+
+def recommend_agent_tuning(profile, flavour, cpu_count, mem_total=None, userparameter_count=0, latency_lst=None,
+                           passive=True):
+    """根据主机资源与监控项负载计算推荐的性能参数。
+
+    Args:
+        profile: ZBX_TUNE_PROFILES 中的配置档名称。
+        flavour: 1 为 agentd，2 为 agent2。
+        cpu_count: CPU 数量。
+        mem_total: 内存字节数，为空时按 1GB 估算。
+        userparameter_count: 已配置的 UserParameter 数量。
+        latency_lst: 实测的监控项耗时秒数列表，超时的监控项以当前 Timeout 计。
+        passive: 是否启用被动检查，StartAgents=0 时不再推荐 StartAgents。
+    Returns:
+        <OrderedDict>: 配置项 -> 推荐值（字符串）。
+    """
+    import math
+    from collections import OrderedDict
+    if profile not in ZBX_TUNE_PROFILES:
+        raise Exception("not supported tune profile {!s}, choose from {!s}".format(profile, ", ".join(sorted(ZBX_TUNE_PROFILES))))
+    conf = ZBX_TUNE_PROFILES[profile]
+    clamp = lambda value, low, high: int(min(max(value, low), high))
+    latency_lst = latency_lst or []
+    mem_gb = max(float(mem_total or 0) / (1 << 30), 1.0)
+    res = OrderedDict()
+    if flavour == 1 and passive:
+        # 每个慢监控项在采集期间会独占一个被动检查进程
+        slow_count = len([i for i in latency_lst if i >= ZBX_TUNE_SLOW_ITEM])
+        agents = max(int(round(cpu_count * conf["agents_per_cpu"])), 1)
+        agents += userparameter_count // conf["userparams_per_agent"] + slow_count
+        res["StartAgents"] = clamp(agents, 1, min(conf["max_agents"], 100))
+    res["BufferSize"] = clamp(conf["buffer_per_gb"] * mem_gb, 2, min(conf["max_buffer"], 65535))
+    res["BufferSend"] = clamp(conf["buffer_send"], 1, 3600)
+    res["Timeout"] = clamp(max(conf["min_timeout"], int(math.ceil(max(latency_lst or [0]) * 2))), 1, 30)
+    res["RefreshActiveChecks"] = clamp(conf["refresh_active"], 1, 86400)
+    if flavour == 2:
+        for plugin in ZBX_TUNE_AGENT2_PLUGINS:
+            res["Plugins.{!s}.System.Capacity".format(plugin)] = clamp(cpu_count * conf["capacity_per_cpu"], 1, 1000)
+    return OrderedDict((k, str(v)) for k, v in res.items())
+
+def measure_item_latency(config_path, effective, probe_keys=None):
+    """实测监控项耗时，未指定 probe_keys 时测量不带参数的 UserParameter 与 agent.ping。
+    agent 未在端口上应答时返回空列表。
+
+    Returns:
+        <list>: 耗时秒数列表，超时的监控项以当前 Timeout 计。
+    """
+    if probe_keys:
+        key_lst = [i.strip() for i in probe_keys.split(",") if i.strip()]
+    else:
+        key_lst = ["agent.ping"] + [i for i in effective.userparameters if not i.endswith("[*]")][:ZBX_TUNE_PROBE_LIMIT]
+    host, port = agent_endpoint(config_path)
+    timeout = int(effective.get("Timeout") or ZBX_GET_TIMEOUT)
+    ping = zabbix_get("agent.ping", host, port)
+    if not ping["ok"]:
+        logging.warning("the agent is not answering on {!s}:{!s}, skip measuring the item latency: {!s}".format(
+            host, port, ping["error"]))
+        return []
+    res = []
+    for i in probe_agent_items(key_lst, host, port, timeout + 1):
+        if i["ok"] or i["kind"] == "notsupported":
+            res.append(i["latency"])
+        elif i["kind"] == "timeout":
+            res.append(float(timeout))
+    return res
+
+@traced("tune")
+def zbx_agent_tune(config_path, service_name, profile=None, flavour=None, probe_keys=None, dry_run=False):
+    """按配置档推荐性能参数，输出与当前配置的差异，并通过 zbx_config_transaction 修改。
+
+    Args:
+        config_path: 主配置文件路径。
+        service_name: agent 的服务名称。
+        profile: 配置档名称，默认使用 ZBX_TUNE_DEFAULT_PROFILE。
+        flavour: 1 为 agentd，2 为 agent2，为空时根据文件名判断。
+        probe_keys: 逗号分隔的用于测量耗时的监控项。
+        dry_run: 为 True 时只输出差异。
+    Returns:
+        <dict>: 包含 profile、facts、recommend、diff 与 report，
+            diff 为 (key, old, new) 列表，dry_run 或无差异时 report 为 None。
+    """
+    profile = profile or ZBX_TUNE_DEFAULT_PROFILE
+    flavour = flavour or config_flavour(config_path)
+    facts = get_host_facts()
+    effective = resolve_effective_config(config_path)
+    latency_lst = measure_item_latency(config_path, effective, probe_keys)
+    recommend = recommend_agent_tuning(profile, flavour, facts.cpu_count, facts.mem_total,
+        len(effective.userparameters), latency_lst, passive=effective.get("StartAgents") != "0")
+    res = {
+        "profile": profile,
+        "facts": {"cpu_count": facts.cpu_count, "mem_total": facts.mem_total, "userparameters": len(effective.userparameters),
+            "max_latency": round(max(latency_lst), 6) if latency_lst else None},
+        "recommend": recommend,
+        "diff": [(k, effective.get(k), v) for k, v in recommend.items() if effective.get(k) != v],
+        "report": None,
+    }
+    logging.info("tune profile {!s}, facts: {!s}".format(profile, ", ".join("{!s}={!s}".format(k, v)
+        for k, v in sorted(res["facts"].items()))))
+    if not res["diff"]:
+        logging.info("All tuning parameters are already set, no change.")
+        return res
+    row_lst = [("KEY", "CURRENT", "RECOMMENDED")] + [(k, "(default)" if old is None else old, new) for k, old, new in res["diff"]]
+    width_lst = [max(len(str(row[n])) for row in row_lst) for n in range(3)]
+    logging.info("the tuning diff is:\n{!s}".format("\n".join("  ".join(str(v).ljust(w) for v, w in zip(row, width_lst)).rstrip()
+        for row in row_lst)))
+    if dry_run:
+        return res
+    res["report"] = zbx_config_transaction(config_path, service_name, dict((k, new) for k, _, new in res["diff"]))
+    return res
+
+# edit 允许修改的配置项，与 zbx_cnf_* 参数一一对应
+_EDIT_KEYS = ("Server", "ServerActive", "Hostname", "ListenPort", "LogFile")
+
+def normalize_edit_dict(edit_dict):
+    """校验并规范化 edit 的参数，execute 与 serve 模式共用。
+
+    Args:
+        edit_dict: 配置项 -> 值，只允许 _EDIT_KEYS 中的配置项，值为字符串或空。
+    Returns:
+        <dict>: 去除首尾空白的 edit_dict，Hostname 为 @@ 时替换为自动选择的 IP 地址。
+    """
+    unknown = sorted(set(edit_dict) - set(_EDIT_KEYS))
+    if unknown:
+        raise Exception("not supported edit params: {!s}, must be in {!s}".format(", ".join(unknown), ", ".join(_EDIT_KEYS)))
+    res = {}
+    for key in _EDIT_KEYS:
+        value = edit_dict.get(key)
+        if value is not None and not isinstance(value, (str, type(u""))):
+            raise Exception("your {!s}:[{!r}] must be a string".format(key, value))
+        res[key] = (value or "").strip()
+    # 参数检查：编辑参数不能为空
+    if not any(res.values()):
+        raise Exception("on mode edit, your edit params is empty")
+    # 检查参数：如果编辑参数存在 ListenPort，则必须为 1024 - 32767 之间的整数
+    if res["ListenPort"]:
+        if not res["ListenPort"].isdigit():
+            raise Exception("your ListenPort:[{!s}] must be an integer".format(res["ListenPort"]))
+        if not (1024 < int(res["ListenPort"]) <= 32767):
+            raise Exception("your ListenPort:[{!s}] must be between 1024 and 32767".format(res["ListenPort"]))
+    # 参数优化：对于 Hostname 如果输入 @@ 符号则表示使用自动检索功能
+    if res["Hostname"] == "@@":
+        logging.info("your zbx_cnf_hostname choice @@, to be auto")
+        res["Hostname"] = get_preferred_ipaddres()
+        if not res["Hostname"]:
+            raise Exception("cannot find a preferred ip address for Hostname=@@")
+        logging.info("the zbx_cnf_hostname change to [{!s}]".format(res["Hostname"]))
+    return res
+
+@traced("execute")
+def execute(mode, zbx_cnf_server, zbx_cnf_activeserver, zbx_cnf_hostname, zbx_cnf_listenport, zbx_cnf_logpath,
+            rollback_generation=1, userparameter_manifest=None, userparameter_target=None, instances=None,
+            probe_keys=None, tune_profile=None, tune_dry_run=None, result=None):
+    """执行单个模式，参数见文件头部的说明。
+
+    Args:
+        result: 不为空时写入本次执行的结构化结果，如状态、事务报告等，用于 JSON 输出。
+    """
+    result = {} if result is None else result
     # Pre Checking
-    os_system = platform.system().lower()
+    facts = get_host_facts()
+    os_system = facts.os_system
     # 可行性分析：对目前不支持的操作系统，拒绝执行
     if os_system not in ("linux", "windows"):
         raise Exception("the OS is [{!s}], not supported now".format(os_system))
     # 可行性分析：检查是否安装了 agent
-    agent_type = collect_zabbix_agent()
+    # 多实例模式下由实例发现决定处理对象，不依赖默认服务名称的检测
+    agent_type = facts.agent_type if not instances else 1
     if agent_type <= 0:
         if mode == "status":
             logging.info("the status is: Noinstall")
+            result["state"] = "NO_INSTALL"
             exit(0)
         raise Exception("the agent is not installed")
-    # 参数优化：如果 mode 为非编辑，则将配置相关的变量置为 None
-    if mode.lower() != "edit":
-        zbx_cnf_server = None
-        zbx_cnf_activeserver = None
-        zbx_cnf_hostname = None
-        zbx_cnf_listenport = None
-        zbx_cnf_logpath = None
-    # 参数检查：如果 mode 为编辑，编辑参数不能为空
-    else:
-        if not any([zbx_cnf_server, zbx_cnf_activeserver, zbx_cnf_hostname, zbx_cnf_listenport, zbx_cnf_logpath]):
-            raise Exception("on mode {!s}, your edit params is empty".format(mode))
-    # 检查参数：如果编辑参数存在 zbx_cnf_listenport，则必须在 1024 - 32767 之间
-    if zbx_cnf_listenport:
-        if '.' in str(zbx_cnf_listenport):
-            raise Exception("your zbx_cnf_listenport:[{!s}] has '.'".format(zbx_cnf_listenport))
-        tmp = int(zbx_cnf_listenport)
-        if not (1024 < tmp <= 32767):
-            raise Exception("your zbx_cnf_listenport:[{!s}] must be between 1024 and 32767".format(zbx_cnf_listenport))
-    # 参数优化：对于 zbx_cnf_hostname 如果输入 @@ 符号则表示使用自动检索功能
-    if zbx_cnf_hostname == "@@":
-        logging.info("your zbx_cnf_hostname choice @@, to be auto")
-        zbx_cnf_hostname = get_preferred_ipaddres()
-        logging.info("the zbx_cnf_hostname change to [{!s}]".format(zbx_cnf_hostname))
+    # 参数检查：只有 mode 为编辑时才使用配置相关的参数，校验与规范化见 normalize_edit_dict
+    edit_dict = {}
+    if mode.lower() == "edit":
+        edit_dict = normalize_edit_dict({
+            "Server": zbx_cnf_server,
+            "ServerActive": zbx_cnf_activeserver,
+            "Hostname": zbx_cnf_hostname,
+            "ListenPort": zbx_cnf_listenport,
+            "LogFile": zbx_cnf_logpath,
+        })
+    # 参数检查：如果 mode 为同步 UserParameter，清单文件不能为空
+    if mode == "sync-userparams" and not userparameter_manifest:
+        raise Exception("on mode {!s}, your userparameter_manifest is empty".format(mode))
+    # 参数检查：如果 mode 为性能调优，配置档必须存在
+    if mode == "tune" and tune_profile and tune_profile not in ZBX_TUNE_PROFILES:
+        raise Exception("on mode {!s}, your tune_profile:[{!s}] must be one of {!s}".format(
+            mode, tune_profile, ", ".join(sorted(ZBX_TUNE_PROFILES))))
     # EOF Pre Checking
 
-    # 编辑配置的配置映射表
-    edit_dict = {
-        "Server": zbx_cnf_server,
-        "ServerActive": zbx_cnf_activeserver,
-        "Hostname": zbx_cnf_hostname,
-        "ListenPort": zbx_cnf_listenport,
-        "LogFile": zbx_cnf_logpath,
-    }
+    # 多实例模式：对选中的实例并发执行，并输出每个实例的结果
+    if instances:
+        if mode not in ("start", "stop", "restart", "status", "edit"):
+            raise Exception("the mode {!s} is not supported for agent instances".format(mode))
+        instance_lst = select_agent_instances(instances)
+        if not instance_lst:
+            raise Exception("the agent is not installed")
+        if mode == "edit" and edit_dict.get("ListenPort") and len(instance_lst) > 1:
+            raise Exception("cannot set the same ListenPort on {!s} agent instances".format(len(instance_lst)))
+        result_lst = run_agent_instances(mode, instance_lst, edit_dict)
+        logging.info("the result of agent instances is:\n{!s}".format(format_instance_table(result_lst)))
+        result["instances"] = result_lst
+        if not all(i["ok"] for i in result_lst):
+            exit(1)
+        return result
 
+    import json
     has_error = False
     try:
         if os_system == "windows":
@@ -477,83 +3115,817 @@ def execute(mode, zbx_cnf_server, zbx_cnf_activeserver, zbx_cnf_hostname, zbx_cn
             service_name = ZBX_LNX_AGENT2_SERVICE_NAME if agent_type == 2 else ZBX_LNX_AGENTD_SERVICE_NAME
         
         if mode == "status":
-            rc = multi_service_action("status", service_name)
             if os_system == "windows":
+                rc = win_service_status(service_name)
                 logging.info("result: {!s}".format(WIN_SERVICE_STATUS_MAPPING[rc]))
+                result["state"] = WIN_SERVICE_STATUS_MAPPING[rc]
             else:
-                logging.info("rc: {!s}".format(rc))
-            exit(0)
-        elif mode == "start":
-            multi_service_action("start", service_name)
-        elif mode == "restart":
-            multi_service_action("restart", service_name)
-        elif mode == "stop":
-            multi_service_action("stop", service_name)
+                # 检测 agent 类型时已批量查询过服务状态，直接复用
+                service_state = facts.service_states.get(service_name) or lnx_query_service_states([service_name],
+                    {service_name: get_zbx_agent_config_path(os_system, agent_type)})[service_name]
+                logging.info("result: {!s}, enabled: {!s}, sub state: {!s}, main pid: {!s}, since: {!s}".format(
+                    service_state.state, service_state.enabled, service_state.sub_state,
+                    service_state.main_pid, service_state.active_enter_timestamp or "-"))
+                result.update(state=service_state.state, enabled=service_state.enabled, sub_state=service_state.sub_state,
+                    main_pid=service_state.main_pid, since=service_state.active_enter_timestamp)
+            if result["state"] == "RUNNING":
+                host, port = agent_endpoint(get_zbx_agent_config_path(os_system, agent_type))
+                ping = zabbix_get("agent.ping", host, port)
+                logging.info("agent.ping on {!s}:{!s}: {!s}, latency {:.4f}s".format(host, port,
+                    ping["value"] if ping["ok"] else ping["error"], ping["latency"]))
+                result["ping"] = ping
+            # 有效配置的指纹，fleet 模式会从输出中提取，用于 drift 模式比较
+            fingerprint = config_fingerprint(resolve_effective_config(get_zbx_agent_config_path(os_system, agent_type)).entries)
+            logging.info("fingerprint: {!s}".format(json.dumps(fingerprint, sort_keys=True)))
+            result["fingerprint"] = fingerprint
+            # 只分析上次 status 之后新增的日志
+            result["log"] = inspect_agent_log(get_zbx_agent_config_path(os_system, agent_type))
+            logging.info(format_log_summary(result["log"]))
+            return result
+        elif mode in ("start", "restart", "stop"):
+            # 记录日志当前的末尾，动作完成后只分析期间新增的日志
+            log_inspector = AgentLogInspector()
+            log_path = agent_log_path(get_zbx_agent_config_path(os_system, agent_type))
+            if log_path:
+                log_inspector.mark(log_path)
+            transition = service_transition(mode, service_name)
+            transition["log"] = inspect_agent_log(get_zbx_agent_config_path(os_system, agent_type), log_inspector)
+            log_inspector.save()
+            result.update(transition)
     except Exception as e:
         has_error = True
         logging.error("it has error, when exec command: {!s}".format(e))
 
     if mode in ("start", "restart", "stop"):
-        if mode != "status":
-            time.sleep(5)
-        if os_system == "windows":
-            logging.info("the status is: \n{0!s}".format(WIN_SERVICE_STATUS_MAPPING[win_service_status(service_name)]))
-        if os_system == "linux":
-            logging.info("the stauts is:")
-            if not lnx_service_action("status", service_name):
-                if mode != "stop":
-                    has_error = True
+        if not has_error:
+            logging.info("the status is: {!s}, took {:.2f}s".format(transition["state"], transition["elapsed"]))
+            logging.info(format_log_summary(transition["log"]))
+            if not transition["ready"]:
+                has_error = True
         if has_error is True:
             exit(1)
     config_path = get_zbx_agent_config_path(os_system, agent_type)
     if mode == "check":
-        zbx_config_check(config_path)
+        res = zbx_config_check(config_path, agent_type)
+        logging.info("check result: {!s}".format(json.dumps(res, sort_keys=True)))
+        result.update(res)
+        # 退出码：0 为校验通过（可能存在 warning），2 为存在 error
+        if res["errors"]:
+            exit(2)
+    elif mode == "rollback":
+        generation = int(rollback_generation)
+        # 与 edit 相同经过快照、重启与校验，回滚涉及的 Include 文件同样纳入快照
+        path_lst = [path for i in load_config_journal(config_path)[:generation] for path in i["files"]]
+        report = zbx_config_transaction(config_path, service_name, None, paths=path_lst,
+            apply=lambda: zbx_config_rollback(config_path, generation))
+        result.update(report)
+        for i in report["phases"]:
+            if i["error"]:
+                logging.error("phase {!s} failed: {!s}".format(i["name"], i["error"]))
+        logging.info(format_transaction_report(report))
+        if report["log"] is not None:
+            logging.info(format_log_summary(report["log"]))
+        if not report["ok"]:
+            raise Exception("the rollback failed on phase {!s}".format(report["failed_phase"]))
+    elif mode == "sync-userparams":
+        manifest = load_userparameter_manifest(userparameter_manifest)
+        target_path = userparameter_target or config_path
+
+        def sync():
+            # 数量记录在 sync 中，避免与事务结果的 changed 冲突
+            res = result["sync"] = zbx_userparameter_sync(config_path, manifest, target_path)
+            return bool(res["added"] or res["changed"] or res["removed"])
+
+        # 与 edit 相同：未变化时跳过重启，重启后校验失败时自动回滚
+        report = zbx_config_transaction(config_path, service_name, None, apply=sync, paths=[target_path])
+        result.update(report)
+        for i in report["phases"]:
+            if i["error"]:
+                logging.error("phase {!s} failed: {!s}".format(i["name"], i["error"]))
+        logging.info(format_transaction_report(report))
+        if report["log"] is not None:
+            logging.info(format_log_summary(report["log"]))
+        if not report["ok"]:
+            raise Exception("the sync failed on phase {!s}".format(report["failed_phase"]))
     elif mode == "edit":
-        zbx_config_edit(config_path, edit_dict)
-        logging.info("begin restart zabbix agent")
-        if not multi_service_action("restart", service_name):
-            raise Exception("restart zabbix agent is bad")
-        time.sleep(5)
-        rc = multi_service_action("status", service_name)
-        if os_system == "windows":
-            logging.info("status: {!s}".format(WIN_SERVICE_STATUS_MAPPING[rc]))
-            if rc != 4:
-                raise Exception("the status of agent is bad")
-        else:
-            logging.info("status: {!s}".format(rc))
-            if not rc:
-                raise Exception("the status of agent is bad")
+        # 配置未发生变化时跳过重启；重启后校验失败时自动回滚
+        report = zbx_config_transaction(config_path, service_name, edit_dict)
+        result.update(report)
+        for i in report["phases"]:
+            if i["error"]:
+                logging.error("phase {!s} failed: {!s}".format(i["name"], i["error"]))
+        logging.info(format_transaction_report(report))
+        if report["log"] is not None:
+            logging.info(format_log_summary(report["log"]))
+        if not report["ok"]:
+            raise Exception("the edit failed on phase {!s}".format(report["failed_phase"]))
+    elif mode == "tune":
+        dry_run = str(tune_dry_run or "").strip().lower() in ("1", "yes", "true")
+        res = zbx_agent_tune(config_path, service_name, tune_profile, agent_type, probe_keys, dry_run)
+        result.update(res)
+        report = res["report"]
+        if report is not None:
+            for i in report["phases"]:
+                if i["error"]:
+                    logging.error("phase {!s} failed: {!s}".format(i["name"], i["error"]))
+            logging.info(format_transaction_report(report))
+            if report["log"] is not None:
+                logging.info(format_log_summary(report["log"]))
+            if not report["ok"]:
+                raise Exception("the tune failed on phase {!s}".format(report["failed_phase"]))
+    elif mode == "probe":
+        host, port = agent_endpoint(config_path)
+        key_lst = [i.strip() for i in (probe_keys or "agent.ping").split(",") if i.strip()]
+        result_lst = probe_agent_items(key_lst, host, port)
+        result["items"] = result_lst
+        for i in result_lst:
+            logging.info("probe {!s}:{!s} {!s}: {!s}, latency {:.4f}s".format(host, port, i["key"],
+                i["value"] if i["ok"] else "ERROR " + i["error"], i["latency"]))
+        if not all(i["ok"] for i in result_lst):
+            exit(1)
+    return result
 
 
-if __name__ == "__main__":
-    # ########## Self Test
-    # INPUT_MODE = "check"
-    # INPUT_ZBX_CNF_SERVER = "1.1.1.1"
-    # INPUT_ZBX_CNF_ACTIVESERVER = ""
-    # INPUT_ZBX_CNF_HOSTNAME = ""
-    # INPUT_ZBX_CNF_LISTENPORT = "10055"
-    # INPUT_ZBX_CNF_LOGPATH = ""
-    # ########## EOF Self Tes
-
-    init_logger("debug")
-
-    # input args deal
-    INPUT_MODE = INPUT_MODE.lower()
-    INPUT_ZBX_CNF_SERVER = INPUT_ZBX_CNF_SERVER.strip()
-    INPUT_ZBX_CNF_HOSTNAME = INPUT_ZBX_CNF_HOSTNAME.strip()
-    INPUT_ZBX_CNF_LISTENPORT = INPUT_ZBX_CNF_LISTENPORT.strip()
-    INPUT_ZBX_CNF_LOGPATH = INPUT_ZBX_CNF_LOGPATH.strip()
-    # EOF input args deal
+class InotifyWatcher(object):
+    """基于 ctypes 调用 inotify 监听目录变化，有变化时调用 callback。
+    不可用时 available 为 False，由调用方退化为比较 mtime。
+    """
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.available = False
+        self._dirs = set()
+        try:
+            import ctypes
+            import ctypes.util
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self._fd = self._libc.inotify_init()
+        except (OSError, AttributeError):
+            return
+        if self._fd < 0:
+            return
+        self.available = True
+        import threading
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, path_lst):
+        """监听 path_lst 所在的目录，原子替换会更换 inode，因此监听目录而不是文件。
+        """
+        if not self.available:
+            return
+        for path in path_lst:
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory in self._dirs:
+                continue
+            if self._libc.inotify_add_watch(self._fd, directory.encode("utf-8"), self._mask) >= 0:
+                self._dirs.add(directory)
+
+    def _loop(self):
+        while True:
+            try:
+                os.read(self._fd, 4096)
+            except OSError:
+                return
+            self.callback()
+
+
+class ZbxController(object):
+    """serve 模式的常驻控制器，在内存中保存主机信息、有效配置与服务状态。
+    配置通过 inotify（不可用时比较各文件的 mtime）失效，服务状态在 SERVE_STATE_TTL 秒内复用，
+    修改类请求通过锁串行执行。
+    """
+    def __init__(self):
+        import threading
+        self.facts = get_host_facts()
+        if self.facts.agent_type <= 0:
+            raise Exception("the agent is not installed")
+        self.service_name = ZBX_LNX_AGENT2_SERVICE_NAME if self.facts.agent_type == 2 else ZBX_LNX_AGENTD_SERVICE_NAME
+        self.config_path = get_zbx_agent_config_path(self.facts.os_system, self.facts.agent_type)
+        self._edit_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._effective = None
+        self._fingerprint = None
+        self._signature = None
+        self._config_dirty = True
+        self._state = None
+        self._state_time = 0
+        self._log_lock = threading.Lock()
+        self.log_inspector = AgentLogInspector()
+        self.watcher = InotifyWatcher(self.invalidate_config)
+
+    def invalidate_config(self):
+        self._config_dirty = True
+
+    def invalidate_state(self):
+        self._state = None
+
+    def inspect_log(self, mark=False):
+        """分析 agent 日志自上次分析后新增的内容，mark 为 True 时只将偏移移动到末尾。
+        LogFile 取自缓存的有效配置，偏移至多每 SERVE_LOG_STATE_INTERVAL 秒写回一次磁盘。
+        """
+        effective = self.effective_config()
+        with self._log_lock:
+            if mark:
+                log_path = agent_log_path(self.config_path, effective)
+                if log_path:
+                    self.log_inspector.mark(log_path)
+                return None
+            res = inspect_agent_log(self.config_path, self.log_inspector, effective)
+            self.log_inspector.save(SERVE_LOG_STATE_INTERVAL)
+            return res
+
+    def save_log_state(self):
+        """立即将日志偏移写回磁盘。
+        """
+        with self._log_lock:
+            self.log_inspector.save()
+
+    @staticmethod
+    def _files_signature(path_lst):
+        res = []
+        for path in path_lst:
+            try:
+                st = os.stat(path)
+                res.append((path, st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                res.append((path, None, None, None))
+        return res
+
+    def effective_config(self):
+        with self._cache_lock:
+            if self._effective is not None and not self._config_dirty and not self.watcher.available:
+                # 没有 inotify 时，以各文件的 (inode, size, mtime) 判断是否变化
+                self._config_dirty = self._files_signature(self._effective.files) != self._signature
+            if self._effective is None or self._config_dirty:
+                self._config_dirty = False
+                self._effective = resolve_effective_config(self.config_path)
+                self._signature = self._files_signature(self._effective.files)
+                self.watcher.watch(self._effective.files)
+            return self._effective
+
+    def fingerprint(self):
+        """有效配置的指纹，与计算时所用的有效配置一起缓存，有效配置重新加载后随之失效。
+        """
+        effective = self.effective_config()
+        with self._cache_lock:
+            if self._fingerprint is None or self._fingerprint[0] is not effective:
+                self._fingerprint = (effective, config_fingerprint(effective.entries))
+            return self._fingerprint[1]
+
+    def service_state(self):
+        with self._cache_lock:
+            if self._state is None or _monotonic() - self._state_time > SERVE_STATE_TTL:
+                self._state = lnx_query_service_states([self.service_name], {self.service_name: self.config_path})[self.service_name]
+                self._state_time = _monotonic()
+            return self._state
+
+    def handle_status(self, params):
+        state = self.service_state()
+        return {"service": self.service_name, "state": state.state, "enabled": state.enabled,
+            "sub_state": state.sub_state, "main_pid": state.main_pid, "since": state.active_enter_timestamp,
+            "log": self.inspect_log(), "fingerprint": self.fingerprint()}
+
+    def handle_check(self, params):
+        entries = self.effective_config().entries
+        validator = validate_config_entries(entries, self.facts.agent_type)
+        return {"config": self.config_path, "entries": [{"key": key, "value": value, "file": path, "line": lineno}
+            for path, lineno, key, value in entries], "errors": len(validator.errors),
+            "warnings": len(validator.warnings), "diagnostics": [i._asdict() for i in validator.diagnostics]}
+
+    def handle_edit(self, params):
+        edit_dict = normalize_edit_dict(dict(params))
+        with self._edit_lock:
+            self.invalidate_state()
+            # 事务从磁盘读取偏移，先写回内存中尚未保存的部分
+            self.save_log_state()
+            report = zbx_config_transaction(self.config_path, self.service_name, edit_dict)
+            self.invalidate_config()
+            self.invalidate_state()
+            # 事务中已分析并保存了重启期间的日志，重新加载偏移
+            with self._log_lock:
+                self.log_inspector = AgentLogInspector()
+            if not report["ok"]:
+                raise Exception(format_transaction_report(report))
+            return report
+
+    def handle_restart(self, params):
+        with self._edit_lock:
+            self.invalidate_state()
+            self.inspect_log(mark=True)
+            transition = service_transition("restart", self.service_name)
+            self.invalidate_state()
+            return {"ready": transition["ready"], "state": transition["state"], "elapsed": transition["elapsed"],
+                "log": self.inspect_log()}
+
+    def handle(self, request):
+        """处理一条请求，请求形如 {"mode": "status", "params": {}}。
+
+        Returns:
+            <dict>: 包含 ok、result、error、elapsed。
+        """
+        begin = _monotonic()
+        res = {"ok": False, "result": None, "error": ""}
+        try:
+            handler = getattr(self, "handle_" + str(request.get("mode", "")), None)
+            if handler is None:
+                raise Exception("not supported mode {!s} on serve".format(request.get("mode")))
+            res["result"] = handler(request.get("params") or {})
+            res["ok"] = True
+        except Exception as e:
+            res["error"] = str(e) or e.__class__.__name__
+        # 常驻进程不保留每次请求的指标
+        get_metrics().reset()
+        res["elapsed"] = round(_monotonic() - begin, 6)
+        return res
+
+
+def serve_controller(socket_path=None):
+    """在 Unix socket 上提供 status/check/edit/restart 服务，每行一个 JSON 请求与一个 JSON 响应。
+    """
+    import json
+    import socket
+    import threading
+    socket_path = socket_path or SERVE_SOCKET_PATH
+    if get_host_facts().os_system != "linux":
+        raise Exception("serve mode is only supported on linux")
+    controller = ZbxController()
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise Exception("the socket {!s} is in use".format(socket_path))
+        except socket.error:
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(16)
+    logging.info("serve on [{!s}], inotify: {!s}".format(socket_path, controller.watcher.available))
+
+    def handle_connection(conn):
+        f = conn.makefile("rwb")
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                except ValueError as e:
+                    res = {"ok": False, "result": None, "error": "bad request: {!s}".format(e)}
+                else:
+                    res = controller.handle(request)
+                f.write((json.dumps(res, sort_keys=True) + "\n").encode("utf-8"))
+                f.flush()
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            conn.close()
 
     try:
-        execute(
-            mode = INPUT_MODE, 
-            zbx_cnf_server = INPUT_ZBX_CNF_SERVER,
-            zbx_cnf_activeserver = INPUT_ZBX_CNF_ACTIVESERVER, 
-            zbx_cnf_hostname = INPUT_ZBX_CNF_HOSTNAME, 
-            zbx_cnf_listenport = INPUT_ZBX_CNF_LISTENPORT, 
-            zbx_cnf_logpath = INPUT_ZBX_CNF_LOGPATH,
-        )
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=handle_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+    finally:
+        server.close()
+        controller.save_log_state()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def controller_request(mode, params=None, socket_path=None, timeout=60):
+    """向 serve 模式的控制器发送一条请求并返回响应。
+    """
+    import json
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path or SERVE_SOCKET_PATH)
+        f = client.makefile("rwb")
+        f.write((json.dumps({"mode": mode, "params": params or {}}) + "\n").encode("utf-8"))
+        f.flush()
+        res = json.loads(f.readline().decode("utf-8"))
+        f.close()
+        return res
+    finally:
+        client.close()
+
+# 远端以 runpy 注入 INPUT_* 全局变量的方式执行本脚本，与平台下发参数的方式一致，
+# 执行前检查脚本的属主为当前 euid 且组与其他用户不可写
+_FLEET_BOOTSTRAP = ("import json,os,runpy,sys;st=os.stat(sys.argv[1]);"
+    "(st.st_uid!=os.geteuid() or st.st_mode&0o22) and sys.exit('untrusted script: '+sys.argv[1]);"
+    "runpy.run_path(sys.argv[1],init_globals=json.loads(sys.argv[2]),run_name='__main__')")
+_FLEET_INPUT_DEFAULTS = ("mode", "zbx_cnf_server", "zbx_cnf_activeserver", "zbx_cnf_hostname", "zbx_cnf_listenport", "zbx_cnf_logpath")
+
+
+class FleetTransport(object):
+    """fleet 模式下在目标主机上执行命令的传输方式。
+    python、script 为该传输方式默认的解释器与脚本路径，为 None 时使用 FLEET_REMOTE_PYTHON 与 FLEET_REMOTE_SCRIPT。
+    """
+    python = None
+    script = None
+
+    def run(self, host, command_lst, timeout):
+        """在 host 上执行 command_lst。
+
+        Returns:
+            <dict>: 包含 rc、output、timed_out。
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _popen(command_lst, timeout):
+        res = run_command(command_lst, timeout)
+        return {"rc": res["rc"], "output": res["output"], "timed_out": res["timed_out"]}
+
+
+class LocalTransport(FleetTransport):
+    """在本机以子进程执行，忽略 host，用于测试与演练。
+    默认以当前解释器执行当前脚本，便于直接验证工作区中的修改。
+    """
+    def __init__(self):
+        self.python = sys.executable
+        # 通过平台以 exec 方式执行时没有 __file__，此时仍使用 FLEET_REMOTE_SCRIPT
+        if "__file__" in globals():
+            self.script = os.path.abspath(globals()["__file__"])
+
+    def run(self, host, command_lst, timeout):
+        return self._popen(command_lst, timeout)
+
+
+class SshTransport(FleetTransport):
+    """通过 ssh 在目标主机上执行。
+    """
+    def __init__(self, ssh_options=None):
+        self.ssh_options = ssh_options or ["-o", "BatchMode=yes", "-o", "ConnectTimeout=10"]
+
+    def run(self, host, command_lst, timeout):
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote
+        remote_command = " ".join(quote(i) for i in command_lst)
+        return self._popen(["ssh"] + self.ssh_options + [host, remote_command], timeout)
+
+
+FLEET_TRANSPORTS = {
+    "local": LocalTransport,
+    "ssh": SshTransport,
+}
+
+def load_fleet_inventory(inventory_path):
+    """读取主机清单。
+    文本格式为每行一个主机，# 开头为注释；JSON 格式为列表，元素为主机名或
+    包含 host 的字典，字典中的其他字段作为该主机的参数覆盖，如 zbx_cnf_hostname。
+
+    Returns:
+        <list>: 字典列表，每个字典至少包含 host。
+    """
+    import json
+    with open(inventory_path, "r") as f:
+        content = f.read()
+    if content.lstrip()[:1] == "[":
+        data = json.loads(content)
+    else:
+        data = [i.strip() for i in content.splitlines() if i.strip() and not i.strip().startswith("#")]
+    return [dict(i) if isinstance(i, dict) else {"host": i} for i in data]
+
+def fleet_command(params, python=None, script=None):
+    """生成在目标主机上执行本脚本的命令。
+
+    Args:
+        params: execute 的参数，如 {"mode": "restart"}。
+    """
+    import json
+    input_dict = dict(("INPUT_" + k.upper(), "") for k in _FLEET_INPUT_DEFAULTS)
+    for k, v in params.items():
+        input_dict["INPUT_" + k.upper()] = v
+    return [python or FLEET_REMOTE_PYTHON, "-c", _FLEET_BOOTSTRAP, script or FLEET_REMOTE_SCRIPT, json.dumps(input_dict)]
+
+def fleet_host_execute(transport, host_entry, params, timeout, retries, remote_python=None, remote_script=None):
+    """在单个主机上执行，失败时按指数退避重试。
+    remote_python、remote_script 为 None 时使用 transport 的默认值。
+
+    Returns:
+        <dict>: 包含 host、ok、rc、attempts、elapsed、timed_out、output，
+            输出中包含配置指纹时（status 模式）还包含 fingerprint。
+    """
+    import json
+    host_params = dict(params)
+    host_params.update((k, v) for k, v in host_entry.items() if k != "host")
+    command_lst = fleet_command(host_params, remote_python or transport.python, remote_script or transport.script)
+    begin = _monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            res = transport.run(host_entry["host"], command_lst, timeout)
+        except Exception as e:
+            res = {"rc": None, "output": str(e), "timed_out": False}
+        if res["rc"] == 0 or attempt > retries:
+            break
+        time.sleep(min(2 ** (attempt - 1), 30))
+    result = {
+        "host": host_entry["host"],
+        "mode": host_params.get("mode"),
+        "ok": res["rc"] == 0,
+        "rc": res["rc"],
+        "attempts": attempt,
+        "elapsed": round(_monotonic() - begin, 3),
+        "timed_out": res["timed_out"],
+        # 只保留输出尾部，避免结果行过大
+        "output": res["output"][-4096:],
+    }
+    # status 输出的配置指纹单独提取，结果可直接作为 drift 模式的输入
+    tmp = re.findall(r"fingerprint: (\{.*\})\s*$", res["output"] or "", re.M)
+    if tmp:
+        try:
+            result["fingerprint"] = json.loads(tmp[-1])
+        except ValueError:
+            pass
+    return result
+
+def run_fleet(inventory_path, params, transport="local", concurrency=None, timeout=None, retries=None,
+              wave_size=0, max_failure_rate=1.0, stream=None, remote_python=None, remote_script=None):
+    """按主机清单批量执行，每完成一个主机即输出一行 JSON 结果。
+    主机按 wave_size 分批滚动执行，一批完成后若累计失败率超过 max_failure_rate 则停止，
+    剩余主机输出为 skipped。
+
+    Args:
+        inventory_path: 主机清单文件。
+        params: execute 的参数，至少包含 mode。
+        transport: FLEET_TRANSPORTS 中的名称，或 FleetTransport 实例。
+        concurrency: 每批内的并发主机数，默认使用 FLEET_CONCURRENCY。
+        timeout: 单主机单次执行的超时秒数，默认使用 FLEET_HOST_TIMEOUT。
+        retries: 失败重试次数，默认使用 FLEET_RETRIES。
+        wave_size: 每批主机数，0 表示不分批。
+        max_failure_rate: 允许的最大失败率，0 ~ 1。
+        stream: 结果输出流，默认为标准输出。
+        remote_python: 目标主机上的解释器，默认使用 transport 的默认值。
+        remote_script: 目标主机上的脚本路径，默认使用 transport 的默认值。
+    Returns:
+        <dict>: 包含 total、ok、failed、skipped、halted。
+    """
+    import json
+    from multiprocessing.pool import ThreadPool
+    if isinstance(transport, str):
+        transport = FLEET_TRANSPORTS[transport]()
+    concurrency = concurrency or FLEET_CONCURRENCY
+    timeout = timeout or FLEET_HOST_TIMEOUT
+    retries = FLEET_RETRIES if retries is None else retries
+    stream = stream or sys.stdout
+    host_lst = load_fleet_inventory(inventory_path)
+    wave_size = wave_size or len(host_lst) or 1
+    summary = {"total": len(host_lst), "ok": 0, "failed": 0, "skipped": 0, "halted": False}
+
+    def emit(res):
+        stream.write(json.dumps(res, sort_keys=True) + "\n")
+        stream.flush()
+
+    pool = ThreadPool(max(1, min(concurrency, wave_size)))
+    try:
+        for offset in range(0, len(host_lst), wave_size):
+            wave = host_lst[offset:offset + wave_size]
+            if summary["halted"]:
+                for i in wave:
+                    emit({"host": i["host"], "mode": params.get("mode"), "ok": False, "skipped": True})
+                summary["skipped"] += len(wave)
+                continue
+            for res in pool.imap_unordered(lambda i: fleet_host_execute(transport, i, params, timeout, retries, remote_python, remote_script), wave):
+                summary["ok" if res["ok"] else "failed"] += 1
+                emit(res)
+            done = summary["ok"] + summary["failed"]
+            if offset + wave_size < len(host_lst) and float(summary["failed"]) / done > max_failure_rate:
+                logging.error("the failure rate {!s}/{!s} is over {!s}, halt the rollout".format(summary["failed"], done, max_failure_rate))
+                summary["halted"] = True
+    finally:
+        pool.close()
+        pool.join()
+    logging.info("fleet result: {!s}".format(json.dumps(summary, sort_keys=True)))
+    return summary
+
+
+def load_drift_spec(spec_path):
+    """读取期望状态，JSON 对象，键为配置项，值为字符串、列表（可重复的配置项）或 null（不应存在）。
+    UserParameter 的值为 key,command 列表，按 item key 分别比较。
+
+    Returns:
+        <dict>: 指纹键 -> 单项指纹，不应存在的配置项为 None。
+    """
+    import json
+    with open(spec_path, "r") as f:
+        spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise Exception("the drift spec:[{!s}] must be a JSON object".format(spec_path))
+    res = {}
+    for key, value in spec.items():
+        if value is None:
+            res[key] = None
+            continue
+        value_lst = value if isinstance(value, list) else [value]
+        entries = [(spec_path, 0, key, str(i)) for i in value_lst]
+        res.update(config_fingerprint(entries)["keys"])
+    return res
+
+def drift_host(fingerprint, spec_keys):
+    """比较单个主机的指纹与期望状态。
+
+    Returns:
+        <dict>: 配置项 -> missing、differs 或 unexpected，无差异时为空。
+    """
+    res = {}
+    host_keys = fingerprint.get("keys", {})
+    for key, value in spec_keys.items():
+        current = host_keys.get(key)
+        if value is None:
+            if current is not None:
+                res[key] = "unexpected"
+        elif current is None:
+            res[key] = "missing"
+        elif current != value:
+            res[key] = "differs"
+    return res
+
+def run_drift(fingerprints_path, spec_path, inventory_path=None, stream=None):
+    """比较各主机的配置指纹与期望状态，只输出存在差异或没有指纹的主机，每个主机一行 JSON。
+    指纹文件为 JSON lines，每行包含 host 与 fingerprint，即 fleet 模式执行 status 的输出。
+    每个主机只比较期望状态中的配置项，耗时与 主机数 x 配置项数 成正比。
+
+    Args:
+        fingerprints_path: 指纹文件。
+        spec_path: 期望状态文件，见 load_drift_spec。
+        inventory_path: 不为空时将存在差异的主机写入该文件，可作为 fleet_inventory 只对这些主机执行。
+        stream: 结果输出流，默认为标准输出。
+    Returns:
+        <dict>: 包含 total、drifted、unknown。
+    """
+    import json
+    stream = stream or sys.stdout
+    spec_keys = load_drift_spec(spec_path)
+    summary = {"total": 0, "drifted": 0, "unknown": 0}
+    host_lst = []
+    with open(fingerprints_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            summary["total"] += 1
+            fingerprint = record.get("fingerprint") or (record if "keys" in record else None)
+            if fingerprint is None:
+                summary["unknown"] += 1
+                stream.write(json.dumps({"host": record.get("host"), "drift": None}, sort_keys=True) + "\n")
+                continue
+            drift = drift_host(fingerprint, spec_keys)
+            if drift:
+                summary["drifted"] += 1
+                host_lst.append(record.get("host"))
+                stream.write(json.dumps({"host": record.get("host"), "drift": drift}, sort_keys=True) + "\n")
+    stream.flush()
+    if inventory_path:
+        with open(inventory_path, "w") as f:
+            f.write("".join("{!s}\n".format(i) for i in host_lst))
+    logging.info("drift result: {!s}".format(json.dumps(summary, sort_keys=True)))
+    return summary
+
+
+CLI_MODES = ("edit", "start", "restart", "stop", "status", "check", "sync-userparams", "probe", "serve", "rollback",
+    "tune", "fleet", "drift")
+# 命令行参数，与 easyops 平台注入的 INPUT_<NAME> 一一对应，见文件头部的说明
+CLI_PARAMS = (
+    "zbx_cnf_server", "zbx_cnf_activeserver", "zbx_cnf_hostname", "zbx_cnf_listenport", "zbx_cnf_logpath",
+    "rollback_generation", "userparameter_manifest", "userparameter_target", "instances", "probe_keys",
+    "tune_profile", "tune_dry_run", "serve_socket",
+    "fleet_mode", "fleet_inventory", "fleet_transport", "fleet_concurrency", "fleet_timeout", "fleet_retries",
+    "fleet_wave_size", "fleet_max_failure_rate", "fleet_remote_python", "fleet_remote_script",
+    "drift_fingerprints", "drift_spec", "drift_inventory",
+    "metrics_file", "metrics_format", "metrics_host",
+    "log_level", "log_file",
+)
+# 各模式必须提供的参数，缺少时按命令行参数错误退出
+CLI_REQUIRED = {
+    "sync-userparams": ("userparameter_manifest",),
+    "fleet": ("fleet_mode", "fleet_inventory"),
+    "drift": ("drift_fingerprints", "drift_spec"),
+}
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog="zbx_runctl", description="zabbix-agent 的启停、配置修改与巡检。")
+    parser.add_argument("mode", choices=CLI_MODES, type=lambda i: i.lower())
+    for name in CLI_PARAMS:
+        parser.add_argument("--" + name.replace("_", "-"), dest=name, default=None)
+    parser.add_argument("--json", action="store_true", help="在标准输出打印一行 JSON 结果，日志输出至标准错误")
+    return parser
+
+def main(argv=None, inputs=None):
+    """命令行入口。
+
+    Args:
+        argv: 命令行参数，为空时使用 sys.argv。
+        inputs: easyops 平台注入的参数，INPUT_<NAME> -> <name>，不为空时忽略 argv。
+    Returns:
+        <int>: 退出码，0 为成功，1 为失败，check 存在 error 或 drift 存在差异时为 2；
+            缺少模式必须的参数时与其他参数错误一样由 argparse 以 2 退出。
+    """
+    import json
+    parser = None
+    if inputs is None:
+        parser = build_arg_parser()
+        opts = vars(parser.parse_args(argv))
+    else:
+        opts = dict((k, inputs.get(k)) for k in CLI_PARAMS)
+        opts["mode"] = str(inputs.get("mode") or "").lower()
+        opts["json"] = str(inputs.get("json") or "").lower() in ("1", "yes", "true")
+    missing = [k for k in CLI_REQUIRED.get(opts["mode"], ()) if not str(opts.get(k) or "").strip()]
+    if missing:
+        # 平台注入参数时只在出错时才构造 parser
+        (parser or build_arg_parser()).error("mode {!s} requires {!s}".format(opts["mode"], ", ".join("--" + k.replace("_", "-") for k in missing)))
+    for k in ("zbx_cnf_server", "zbx_cnf_activeserver", "zbx_cnf_hostname", "zbx_cnf_listenport", "zbx_cnf_logpath"):
+        opts[k] = str(opts.get(k) or "").strip()
+    init_logger(opts.get("log_level") or "debug", opts.get("log_file"))
+    mode = opts["mode"]
+    begin = _monotonic()
+    result = {}
+    rc = 0
+    try:
+        # serve 模式常驻运行，通过 Unix socket 接收请求
+        if mode == "serve":
+            serve_controller(opts.get("serve_socket"))
+        # drift 模式在控制端运行，比较 fleet status 收集的配置指纹与期望状态
+        elif mode == "drift":
+            result = run_drift(opts.get("drift_fingerprints"), opts.get("drift_spec"), inventory_path=opts.get("drift_inventory"))
+            rc = 2 if result["drifted"] else 0
+        # fleet 模式在控制端运行，按主机清单对每台主机执行 fleet_mode
+        elif mode == "fleet":
+            fleet_params = {"mode": opts.get("fleet_mode")}
+            for k in _FLEET_INPUT_DEFAULTS[1:]:
+                fleet_params[k] = opts[k]
+            # 其余模式参数原样下发，如 tune 模式的配置档可在整个主机清单上统一应用
+            for k in ("probe_keys", "tune_profile", "tune_dry_run"):
+                if opts.get(k):
+                    fleet_params[k] = opts[k]
+            result = run_fleet(
+                opts.get("fleet_inventory"),
+                fleet_params,
+                transport = opts.get("fleet_transport") or "ssh",
+                concurrency = int(opts.get("fleet_concurrency") or 0),
+                timeout = float(opts.get("fleet_timeout") or 0),
+                retries = int(opts.get("fleet_retries") or FLEET_RETRIES),
+                wave_size = int(opts.get("fleet_wave_size") or 0),
+                max_failure_rate = float(opts.get("fleet_max_failure_rate") or 1.0),
+                remote_python = opts.get("fleet_remote_python") or None,
+                remote_script = opts.get("fleet_remote_script") or None,
+            )
+            rc = 0 if not result["failed"] and not result["halted"] else 1
+        else:
+            execute(
+                mode = mode,
+                zbx_cnf_server = opts["zbx_cnf_server"],
+                zbx_cnf_activeserver = opts["zbx_cnf_activeserver"],
+                zbx_cnf_hostname = opts["zbx_cnf_hostname"],
+                zbx_cnf_listenport = opts["zbx_cnf_listenport"],
+                zbx_cnf_logpath = opts["zbx_cnf_logpath"],
+                rollback_generation = opts.get("rollback_generation") or 1,
+                userparameter_manifest = opts.get("userparameter_manifest"),
+                userparameter_target = opts.get("userparameter_target"),
+                instances = opts.get("instances"),
+                probe_keys = opts.get("probe_keys"),
+                tune_profile = opts.get("tune_profile"),
+                tune_dry_run = opts.get("tune_dry_run"),
+                result = result,
+            )
+    except SystemExit as e:
+        rc = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
     except Exception as e:
         logging.exception(e)
-        exit(1)
\ No newline at end of file
+        result["error"] = str(e) or e.__class__.__name__
+        rc = 1
+    finally:
+        emit_metrics(
+            metrics_file = opts.get("metrics_file"),
+            metrics_format = opts.get("metrics_format") or "json",
+            host = opts.get("metrics_host") or "-",
+        )
+    if opts.get("json"):
+        sys.stdout.write(json.dumps({"mode": mode, "ok": rc == 0, "rc": rc, "elapsed": round(_monotonic() - begin, 6),
+            "result": result}, sort_keys=True, default=str) + "\n")
+        sys.stdout.flush()
+    return rc
+
+
+if __name__ == "__main__":
+    # easyops 平台以 INPUT_<NAME> 全局变量传入参数，没有注入时按命令行解析，如：
+    #   python zbx_runctl.py status --json
+    #   python zbx_runctl.py edit --zbx-cnf-server 10.0.0.1 --zbx-cnf-hostname @@
+    inputs = dict((k[len("INPUT_"):].lower(), v) for k, v in list(globals().items()) if k.startswith("INPUT_"))
+    sys.exit(main(inputs=inputs or None))